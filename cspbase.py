@@ -1,5 +1,12 @@
 import time
 import functools
+import itertools
+import heapq
+import array
+import threading
+import random
+import multiprocessing
+import queue
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -30,9 +37,31 @@ import functools
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
+      CompactTableConstraint stores the same kind of table as bitsets
+      (Compact-Table) to save space and speed up GAC.
+
+      An IntensionalConstraint is instead specified by a predicate
+      function over the values of its scope (or by a subclass that
+      overrides check and has_support, e.g., CardinalityConstraint,
+      CapacityConstraint, CumulativeConstraint and
+      AllDifferentConstraint), so no table of tuples needs to be
+      stored.
+
+      An ObjectiveConstraint is an objective to minimize with 
+      BT.minimize (e.g., LoadImbalanceObjective, OvertimeObjective,
+      PenaltyObjective): the bound on its value, tightened with each
+      solution found, is enforced by the propagators.
+
     C) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
-       executed depending on the propagator used.
+       executed depending on the propagator used. The search can be
+       given node, failure and time budgets and a CancelToken, and 
+       BT.solve returns a SearchResult. Nothing is printed unless BT
+       is given a reporter (e.g., a ConsoleReporter).
+
+       portfolio_solve races several configurations of BT (propagator,
+       value ordering, random seed) in worker processes, and 
+       BT.solve_parallel splits one search between worker processes.
 
 '''
 
@@ -46,6 +75,7 @@ class Variable:
        The variable object offers two types of functionality to support
        search. 
        (a) It has a current domain, implimented as a set of flags 
+           (a bytearray, with a count of the flags that are set)
            determining which domain values are "current", i.e., unpruned.
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
@@ -72,6 +102,11 @@ class Variable:
            flags are not changed so that pruning and unpruning can
            work independently of assignment and unassignment. 
            '''
+
+    #incremented whenever a current domain or an assignment changes,
+    #so constraints can cache what they compute from the domains
+    changes = 0
+
     #
     #set up and info methods
     #
@@ -81,17 +116,26 @@ class Variable:
         '''
         self.name = name                #text name for variable
         self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.dom_index = dict()         #value -> position in dom
+        for i, val in enumerate(self.dom):
+            self.dom_index.setdefault(val, i)
+        self.curdom = bytearray([1] * len(domain))  #1 if value is current
+        self.curdom_size = len(domain)  #number of current values
         #for bt_search
         self.assignedValue = None
+        #constraints to be told when this variable is assigned/unassigned
+        self.watchers = []
         #self.var_type = var_type
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            self.dom_index.setdefault(val, len(self.dom))
             self.dom.append(val)
-            self.curdom.append(True)
+            self.curdom.append(1)
+            self.curdom_size = self.curdom_size + 1
+        Variable.changes = Variable.changes + 1
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -107,11 +151,19 @@ class Variable:
 
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        i = self.value_index(value)
+        if self.curdom[i]:
+            self.curdom[i] = 0
+            self.curdom_size = self.curdom_size - 1
+            Variable.changes = Variable.changes + 1
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        i = self.value_index(value)
+        if not self.curdom[i]:
+            self.curdom[i] = 1
+            self.curdom_size = self.curdom_size + 1
+            Variable.changes = Variable.changes + 1
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
@@ -129,31 +181,33 @@ class Variable:
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.dom_index.get(value)
+        if i is None:
             return False
         if self.is_assigned():
             return value == self.get_assigned_value()
         else:
-            return self.curdom[self.value_index(value)]
+            return self.curdom[i] == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
         if self.is_assigned():
             return 1
         else:
-            return(sum(1 for v in self.curdom if v))
+            return self.curdom_size
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = bytearray([1] * len(self.dom))
+        self.curdom_size = len(self.dom)
+        Variable.changes = Variable.changes + 1
 
     #
     #methods for assigning and unassigning
     #
 
     def is_assigned(self):
-        return self.assignedValue != None
+        return self.assignedValue is not None
     
     def assign(self, value):
         '''Used by bt_search. When we assign we remove all other values
@@ -166,18 +220,31 @@ class Variable:
             return
 
         self.assignedValue = value
+        Variable.changes = Variable.changes + 1
+        for c in self.watchers:
+            c.var_assigned(self, value)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
         if not self.is_assigned():
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
+        value = self.assignedValue
         self.assignedValue = None
+        Variable.changes = Variable.changes + 1
+        for c in self.watchers:
+            c.var_unassigned(self, value)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
         return self.assignedValue
 
+    def add_watcher(self, c):
+        '''Register constraint c to have its var_assigned and 
+           var_unassigned methods called when this variable is 
+           assigned or unassigned'''
+        self.watchers.append(c)
+
     #
     #internal methods
     #
@@ -185,7 +252,7 @@ class Variable:
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.dom_index[value]
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -197,7 +264,7 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [f == 1 for f in self.curdom]))
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
@@ -215,9 +282,9 @@ class Constraint:
         in the scope such that this sequence of values satisfies the
         constraints).
 
-        NOTE: This is a very space expensive representation...a proper
-        constraint object would allow for representing the constraint
-        with a function.  
+        NOTE: This is a very space expensive representation...see
+        IntensionalConstraint for representing the constraint with a
+        function.
         '''
 
         self.scope = list(scope)
@@ -230,12 +297,37 @@ class Constraint:
         #pair.
         self.sup_tuples = dict()
 
+        #residues: (var, val) -> the last tuple found supporting it. 
+        #Checked first by has_support and kept across backtracking.
+        self.residues = dict()
+        #GAC-2001: (var, val) -> index in sup_tuples[(var,val)] before
+        #which no tuple is valid. Restored on backtracking.
+        self.last = dict()
+
+        #weight for the dom/wdeg heuristic, increased by bt_search each
+        #time this constraint causes a dead end
+        self.weight = 1
+
+        #the search Trail while bt_search is running (see CSP.set_trail)
+        self.trail = None
+
+        #number of unassigned variables in the scope, kept up to date
+        #by watching the variables
+        self.n_unasgn = 0
+        for v in self.scope:
+            if not v.is_assigned():
+                self.n_unasgn = self.n_unasgn + 1
+            v.add_watcher(self)
+
     def add_satisfying_tuples(self, tuples):
-        '''We specify the constraint by adding its complete list of satisfying tuples.'''
+        '''We specify the constraint by adding its complete list of satisfying tuples.
+           tuples can be any iterable, e.g., a generator (see filtered_product), 
+           so the tuples need not all be in memory before they are stored.'''
         for x in tuples:
             t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
+            if t in self.sat_tuples:
+                continue
+            self.sat_tuples[t] = True
 
             #now put t in as a support for all of the variable values in it
             for i, val in enumerate(t):
@@ -259,11 +351,7 @@ class Constraint:
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
-        n = 0
-        for v in self.scope:
-            if not v.is_assigned():
-                n = n + 1
-        return n
+        return self.n_unasgn
 
     def get_unasgn_vars(self): 
         '''return list of unassigned variables in constraint's scope. Note
@@ -274,17 +362,103 @@ class Constraint:
                 vs.append(v)
         return vs
 
+    def cost(self):
+        '''Rough estimate of the work needed to revise this constraint,
+           used to order the GAC queue (cheap constraints first)'''
+        return len(self.sat_tuples) + len(self.scope)
+
     def has_support(self, var, val):
         '''Test if a variable value pair has a supporting tuple (a set
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
+
+           The residue (last support found) for the pair is tried first.
+           When a new support is found it becomes the residue of every
+           variable value pair in it (as in GAC-3rm).
         '''
+        t = self.residues.get((var, val))
+        if t is not None and self.tuple_is_valid(t):
+            return True
         if (var, val) in self.sup_tuples:
             for t in self.sup_tuples[(var, val)]:
                 if self.tuple_is_valid(t):
+                    for i, v in enumerate(self.scope):
+                        self.residues[(v, t[i])] = t
                     return True
         return False
 
+    def has_support_2001(self, var, val, trail):
+        '''GAC-2001 version of has_support. Tuples supporting the pair
+           are scanned starting from where the last successful scan
+           stopped (tuples before it are known to be invalid as domains
+           only shrink below a search node). The position is saved on the
+           trail so it is restored when the search backtracks; without a
+           trail it is not advanced.'''
+        key = (var, val)
+        tuples = self.sup_tuples.get(key, [])
+        last = self.last.get(key, 0)
+        i = last
+        while i < len(tuples) and not self.tuple_is_valid(tuples[i]):
+            i = i + 1
+        if i != last and trail is not None:
+            trail.save(self.last, key, last)
+            self.last[key] = i
+        return i < len(tuples)
+
+    def can_fix(self, var):
+        '''Return True if fix_var can fold var into the constraint'''
+        return True
+
+    def fix_var(self, var, val):
+        '''Fold the fixed assignment var = val into the constraint and
+           remove var from the scope (see CSP.eliminate_fixed_vars). For
+           a table this keeps the tuples with val in var's position,
+           minus that position.'''
+        i = self.scope.index(var)
+        tuples = [t[:i] + t[i+1:] for t in self.sat_tuples if t[i] == val]
+        self.remove_from_scope(var)
+        self.sat_tuples = dict()
+        self.sup_tuples = dict()
+        self.residues = dict()
+        self.last = dict()
+        self.add_satisfying_tuples(tuples)
+
+    def fixed_part_violated(self):
+        '''Return True if the constants folded in by fix_var already
+           violate the constraint whatever the rest of the scope takes 
+           (see CSP.eliminate_fixed_vars). A table just loses tuples, 
+           which the propagators see, so there is nothing to test.'''
+        return False
+
+    def is_entailed(self):
+        '''Return True if every assignment of the scope from the
+           (permanent) domains satisfies the constraint, so it can be
+           dropped (see CSP.drop_entailed_constraints). Only cheap tests
+           are made, so False just means "not known to be entailed".
+           Here we only test unary constraints, value by value.'''
+        if len(self.scope) != 1:
+            return False
+        return all(self.check([val]) for val in self.scope[0].domain())
+
+    def remove_from_scope(self, var):
+        '''Internal routine for fix_var. Take var out of the scope and
+           stop watching it'''
+        self.scope.remove(var)
+        var.watchers.remove(self)
+        if not var.is_assigned():
+            self.n_unasgn = self.n_unasgn - 1
+
+    def var_assigned(self, var, val):
+        '''Called when a variable in the scope is assigned (every
+           constraint watches the variables of its scope). Constraints 
+           keeping more incremental state extend it.'''
+        self.n_unasgn = self.n_unasgn - 1
+
+    def var_unassigned(self, var, val):
+        '''Called when a variable in the scope is unassigned; undoes
+           var_assigned'''
+        self.n_unasgn = self.n_unasgn + 1
+
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
@@ -296,6 +470,910 @@ class Constraint:
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class CompactTableConstraint(Constraint):
+    '''Table constraint using the Compact-Table representation. It is
+       specified by satisfying tuples, like Constraint, but
+
+       - the tuples are stored once, as one array of value indices per
+         variable of the scope (rather than once per variable in
+         sup_tuples plus once in sat_tuples),
+       - for each variable value pair there is a bitset (a Python int
+         used as an arbitrary length bit vector) with bit k set if
+         tuple k contains the pair,
+       - the current table is a bitset of the tuples that are still
+         valid (every value in its variable's current domain).
+
+       The current table is brought up to date by ANDing it with the
+       union of the supports of each variable whose domain shrank, and
+       var = val has support iff its bitset intersects the current 
+       table. The current table is saved on the search trail when it
+       changes, so it is restored when the search backtracks.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.position = dict()
+        for i, var in enumerate(self.scope):
+            self.position.setdefault(var, i)
+        self.columns = [array.array('l') for var in self.scope]
+        self.size = 0               #number of tuples (rows of columns)
+        self.rows = dict()          #(i, val) -> bitset as bytearray, until built
+        self.supports = None        #(i, val) -> bitset
+        #reversible state: 'table' is the current table, i is the
+        #current domain size of scope[i] it was computed for
+        self.state = dict()
+
+    def add_satisfying_tuples(self, tuples):
+        '''Add the satisfying tuples (any iterable of sequences of values
+           ordered as the scope). Tuples with a value not in the domain of
+           its variable can never be valid and are dropped.'''
+        if self.supports is not None:
+            #reopen the bitsets for adding more tuples
+            for key, bits in self.supports.items():
+                self.rows[key] = bytearray(bits.to_bytes(self.n_tuples() // 8 + 1, 'little'))
+            self.supports = None
+        for t in tuples:
+            t = tuple(t)
+            if not all(val in self.scope[i].dom_index for i, val in enumerate(t)):
+                continue
+            k = self.n_tuples()
+            self.size = k + 1
+            for i, val in enumerate(t):
+                self.columns[i].append(self.scope[i].value_index(val))
+                b = self.rows.get((i, val))
+                if b is None:
+                    b = self.rows[(i, val)] = bytearray()
+                if len(b) <= k >> 3:
+                    b.extend(bytes((k >> 3) + 1 - len(b)))
+                b[k >> 3] |= 1 << (k & 7)
+
+    def build(self):
+        '''Turn the bitsets being built into ints'''
+        if self.supports is None:
+            self.supports = dict()
+            for key, b in self.rows.items():
+                self.supports[key] = int.from_bytes(b, 'little')
+            self.rows = dict()
+            self.state = dict()
+
+    def n_tuples(self):
+        return self.size
+
+    def cost(self):
+        return self.n_tuples() // 64 + len(self.scope)
+
+    def check(self, vals):
+        self.build()
+        bits = (1 << self.n_tuples()) - 1
+        for i, val in enumerate(vals):
+            bits = bits & self.supports.get((i, val), 0)
+            if not bits:
+                return False
+        return bits != 0
+
+    def var_mask(self, i):
+        '''Union of the supports of the current domain of scope[i]'''
+        m = 0
+        for val in self.scope[i].cur_domain():
+            m = m | self.supports.get((i, val), 0)
+        return m
+
+    def update_table(self):
+        '''Remove from the current table the tuples made invalid by
+           domain reductions since the last update'''
+        self.build()
+        state = self.state
+        trail = self.trail
+        table = state.get('table')
+        if table is not None:
+            for i, var in enumerate(self.scope):
+                size = var.cur_domain_size()
+                if size > state[i]:
+                    #domain restored behind our back: start again
+                    table = None
+                    break
+                if size < state[i]:
+                    trail.save(state, i, state[i])
+                    state[i] = size
+                    table = table & self.var_mask(i)
+            if table is not None:
+                if table != state['table']:
+                    trail.save(state, 'table', state['table'])
+                    state['table'] = table
+                return table
+
+        #No current table. Without a trail we cannot tell when domains
+        #are restored, so it is recomputed every time.
+        table = (1 << self.n_tuples()) - 1
+        for i, var in enumerate(self.scope):
+            table = table & self.var_mask(i)
+            state[i] = var.cur_domain_size()
+        if trail is not None:
+            trail.save(state, 'table', state.get('table'))
+            state['table'] = table
+        return table
+
+    def has_support(self, var, val):
+        table = self.update_table()
+        return (self.supports.get((self.position[var], val), 0) & table) != 0
+
+    def has_support_2001(self, var, val, trail):
+        return self.has_support(var, val)
+
+    def fix_var(self, var, val):
+        i = self.position[var]
+        idx = var.value_index(val)
+        scope = list(self.scope)
+        tuples = []
+        for k in range(self.n_tuples()):
+            if self.columns[i][k] == idx:
+                tuples.append(tuple(scope[j].dom[self.columns[j][k]] 
+                                    for j in range(len(scope)) if j != i))
+        self.remove_from_scope(var)
+        self.position = dict()
+        for j, v in enumerate(self.scope):
+            self.position.setdefault(v, j)
+        self.columns = [array.array('l') for v in self.scope]
+        self.size = 0
+        self.rows = dict()
+        self.supports = None
+        self.state = dict()
+        self.add_satisfying_tuples(tuples)
+
+class IntensionalConstraint(Constraint):
+    '''Constraint represented by a function rather than a table of
+       satisfying tuples. The propagators only use the check and
+       has_support methods, so an intensional constraint can be used
+       anywhere a table constraint can.
+
+       Either pass a predicate, a function taking the list of values
+       (ordered as the scope) and returning True if they satisfy the
+       constraint, or subclass and override check and has_support with
+       something more specialized.'''
+
+    def __init__(self, name, scope, predicate=None):
+        Constraint.__init__(self, name, scope)
+        self.predicate = predicate
+
+    def add_satisfying_tuples(self, tuples):
+        print("Trying to add satisfying tuples to intensional constraint ", self)
+
+    def check(self, vals):
+        '''Apply the predicate to the list of values'''
+        return self.predicate(vals)
+
+    def has_support_2001(self, var, val, trail):
+        '''No tables to scan, same as has_support'''
+        return self.has_support(var, val)
+
+    def can_fix(self, var):
+        '''A predicate cannot in general be rewritten without var'''
+        return False
+
+    def cost(self):
+        '''The generic has_support may enumerate the product of the
+           domains'''
+        n = 1
+        for v in self.scope:
+            n = n * v.domain_size()
+        return n
+
+    def has_support(self, var, val):
+        '''Generic support test: search the current domains of the
+           other variables (with var fixed to val) for a tuple
+           satisfying check. Tuples are generated one at a time and
+           never stored. Subclasses should override this with a
+           cheaper test when the structure of the constraint allows.'''
+        doms = []
+        for v in self.scope:
+            if v is var:
+                doms.append([val])
+            else:
+                doms.append(v.cur_domain())
+        for t in itertools.product(*doms):
+            if self.check(t):
+                return True
+        return False
+
+class CardinalityConstraint(IntensionalConstraint):
+    '''Global cardinality constraint. Each value named in bounds must
+       be taken by at least its minimum and at most its maximum number
+       of variables in the scope. Values not named in bounds are
+       unrestricted.
+
+       Unlike the table constraint no satisfying tuples are stored,
+       support is decided by counting how many variables are fixed to
+       (or can still take) each value.'''
+
+    def __init__(self, name, scope, bounds):
+        '''bounds is a dictionary mapping a domain value to a pair
+           (min, max) giving the number of scope variables that
+           must/may take that value'''
+        IntensionalConstraint.__init__(self, name, scope)
+        self.bounds = dict(bounds)
+        self.stamp = None           #Variable.changes the counts are for
+        self.counts = None
+
+    def cost(self):
+        '''The counts over the whole scope are redone once per change
+           of domains, then each support test is over the bounds'''
+        return sum(v.domain_size() for v in self.scope) + len(self.bounds)
+
+    def can_fix(self, var):
+        return True
+
+    def fix_var(self, var, val):
+        '''One fewer variable may/must take val'''
+        self.remove_from_scope(var)
+        self.stamp = None
+        if val in self.bounds:
+            lo, hi = self.bounds[val]
+            self.bounds[val] = (lo - 1, hi - 1)
+
+    def fixed_part_violated(self):
+        '''More variables were fixed to some value than its maximum'''
+        return any(hi < 0 for lo, hi in self.bounds.values())
+
+    def is_entailed(self):
+        '''Entailed if for each value the variables fixed to it already
+           meet the minimum and those that can take it cannot exceed the
+           maximum'''
+        fixed = dict()
+        possible = dict()
+        for v in self.scope:
+            dom = v.domain()
+            if len(dom) == 1:
+                fixed[dom[0]] = fixed.get(dom[0], 0) + 1
+            for val in set(dom):
+                possible[val] = possible.get(val, 0) + 1
+        for val, (lo, hi) in self.bounds.items():
+            if fixed.get(val, 0) < lo or possible.get(val, 0) > hi:
+                return False
+        return True
+
+    def check(self, vals):
+        '''Count the occurrences of each value and compare them with
+           the bounds'''
+        counts = dict()
+        for val in vals:
+            counts[val] = counts.get(val, 0) + 1
+        for val, (lo, hi) in self.bounds.items():
+            n = counts.get(val, 0)
+            if n < lo or n > hi:
+                return False
+        return True
+
+    def current_counts(self):
+        '''Return a summary of the current domains: (fixed, free, need,
+           over, under, tight) where fixed maps each value to the number
+           of variables fixed to it (singleton current domain), free is
+           the number not fixed, need the sum of the minimums not yet
+           met by fixed variables, over the values fixed more than their
+           maximum, under True if some value is possible for fewer
+           variables than its minimum, and tight the values possible
+           for exactly their minimum. Cached until a domain changes.'''
+        if self.stamp != Variable.changes:
+            fixed = dict()
+            possible = dict()
+            free = 0
+            for v in self.scope:
+                dom = v.cur_domain()
+                if len(dom) == 1:
+                    fixed[dom[0]] = fixed.get(dom[0], 0) + 1
+                else:
+                    free = free + 1
+                for d in dom:
+                    possible[d] = possible.get(d, 0) + 1
+            need = 0
+            over = set()
+            under = False
+            tight = []
+            for w, (lo, hi) in self.bounds.items():
+                n = fixed.get(w, 0)
+                p = possible.get(w, 0)
+                if n > hi:
+                    over.add(w)
+                if p < lo:
+                    under = True
+                elif p == lo:
+                    tight.append(w)
+                need = need + max(0, lo - n)
+            self.counts = (fixed, free, need, over, under, tight)
+            self.stamp = Variable.changes
+        return self.counts
+
+    def has_support(self, var, val):
+        '''var = val is supported unless, with the other variables
+           counted as fixed (singleton current domain) or free,
+           (a) too many variables are fixed to some value,
+           (b) too few variables can still take some value, or
+           (c) there are not enough free variables left to make up
+               the minimums that are still outstanding.
+           When all other variables are fixed this is exactly check.
+           The counts of current_counts include var, so only the values
+           var is fixed to, can take, or is tested with change.'''
+        fixed, free, need, over, under, tight = self.current_counts()
+        if under:
+            return False
+        single = None
+        if var.cur_domain_size() == 1:
+            single = var.cur_domain()[0]
+        else:
+            free = free - 1
+
+        #(b) var no longer counts towards the values it could take
+        for w in tight:
+            if w != val and var.in_cur_domain(w):
+                return False
+        #(a) and (c) for the values whose fixed count changes
+        if single == val:
+            return not over and need <= free
+        for w in over:
+            if w != single:
+                return False
+        for w, delta in ((single, -1), (val, 1)):
+            if w in self.bounds:
+                lo, hi = self.bounds[w]
+                n = fixed.get(w, 0)
+                if n + delta > hi:
+                    return False
+                need = need - max(0, lo - n) + max(0, lo - n - delta)
+        return need <= free
+
+class CapacityConstraint(IntensionalConstraint):
+    '''Constraint that each value named in capacities is taken by at
+       most that many variables of the scope, e.g., each use of a non
+       reusable resource is a variable and the capacity is the quantity
+       available.
+
+       The number of assigned variables taking each value is tracked
+       incrementally (as constraints watch their variables), and for
+       each value we keep the variables that could take it. So memory
+       is proportional to the number of variables.'''
+
+    def __init__(self, name, scope, capacities):
+        '''capacities is a dictionary mapping a domain value to the
+           maximum number of scope variables that may take it'''
+        IntensionalConstraint.__init__(self, name, scope)
+        self.capacities = dict(capacities)
+        self.used = dict()
+        self.users = dict()
+        for v in self.scope:
+            for val in v.domain():
+                if val in self.capacities:
+                    self.users.setdefault(val, []).append(v)
+            if v.is_assigned():
+                val = v.get_assigned_value()
+                self.used[val] = self.used.get(val, 0) + 1
+
+    def cost(self):
+        return 2 * len(self.scope)
+
+    def can_fix(self, var):
+        return True
+
+    def fix_var(self, var, val):
+        '''A fixed use is a constant: it just reduces the capacity'''
+        self.remove_from_scope(var)
+        for users in self.users.values():
+            if var in users:
+                users.remove(var)
+        if val in self.capacities:
+            self.capacities[val] = self.capacities[val] - 1
+
+    def fixed_part_violated(self):
+        '''The fixed uses of some value already exceed its capacity'''
+        return any(cap < 0 for cap in self.capacities.values())
+
+    def is_entailed(self):
+        '''Entailed if no value has more possible users than capacity'''
+        for val, cap in self.capacities.items():
+            if len(self.users.get(val, [])) > cap:
+                return False
+        return True
+
+    def var_assigned(self, var, val):
+        IntensionalConstraint.var_assigned(self, var, val)
+        self.used[val] = self.used.get(val, 0) + 1
+
+    def var_unassigned(self, var, val):
+        IntensionalConstraint.var_unassigned(self, var, val)
+        self.used[val] = self.used[val] - 1
+
+    def check(self, vals):
+        counts = dict()
+        for val in vals:
+            counts[val] = counts.get(val, 0) + 1
+        for val, cap in self.capacities.items():
+            if counts.get(val, 0) > cap:
+                return False
+        return True
+
+    def has_support(self, var, val):
+        '''var = val is supported if the number of other variables 
+           forced to val (assigned, or with val as the only value left in
+           their current domain) leaves room for one more use. If fewer
+           variables than the capacity can take val at all it is always
+           supported.'''
+        if not val in self.capacities:
+            return True
+        cap = self.capacities[val]
+        users = self.users.get(val, [])
+        if len(users) <= cap:
+            return True
+
+        n = self.used.get(val, 0)
+        if var.get_assigned_value() == val:
+            n = n - 1
+        for v in users:
+            if (not v is var and not v.is_assigned() 
+                and v.cur_domain_size() == 1 and v.in_cur_domain(val)):
+                n = n + 1
+                if n >= cap:
+                    return False
+        return n < cap
+
+class CumulativeConstraint(IntensionalConstraint):
+    '''Constraint over variables that are each active during a time
+       interval [start, end): at every point in time, the number of
+       active variables taking a value named in capacities is at most
+       that value's capacity, e.g., each use of a reusable resource by
+       an appointment is a variable and the resource can be shared by
+       appointments that do not overlap.
+
+       Support is decided by a sweep over the start/end events of the
+       intervals, so no tuples and no per-time-unit buckets are needed.'''
+
+    def __init__(self, name, scope, intervals, capacities):
+        '''intervals is a list of (start, end) pairs, one for each
+           variable of the scope (in the same ORDER).
+           capacities is a dictionary mapping a domain value to the 
+           maximum number of simultaneously active variables that may
+           take it'''
+        IntensionalConstraint.__init__(self, name, scope)
+        self.intervals = dict()
+        for i, var in enumerate(self.scope):
+            self.intervals[var] = tuple(intervals[i])
+        self.capacities = dict(capacities)
+        #for each value, the (start, end, var) of the variables that 
+        #could take it, sorted by start time
+        self.users = dict()
+        for var in self.scope:
+            start, end = self.intervals[var]
+            for val in var.domain():
+                if val in self.capacities:
+                    self.users.setdefault(val, []).append((start, end, var))
+        for val in self.users:
+            self.users[val].sort(key=lambda u: u[:2])
+        #for each value, the intervals of variables fixed to it by
+        #fix_var; they are always active
+        self.fixed = dict()
+
+    def cost(self):
+        return 4 * len(self.scope)
+
+    def can_fix(self, var):
+        return True
+
+    def fix_var(self, var, val):
+        '''Keep var's interval as a constant use of val'''
+        self.remove_from_scope(var)
+        for val2 in self.users:
+            self.users[val2] = [u for u in self.users[val2] if not u[2] is var]
+        if val in self.capacities:
+            self.fixed.setdefault(val, []).append(self.intervals[var])
+        del self.intervals[var]
+
+    def fixed_part_violated(self):
+        '''The fixed uses of some value overlap more than its capacity'''
+        for val, ivs in self.fixed.items():
+            if max_overlap(ivs) > self.capacities[val]:
+                return True
+        return False
+
+    def is_entailed(self):
+        '''Entailed if no value is ever needed by more variables at
+           once than its capacity'''
+        for val, cap in self.capacities.items():
+            intervals = [u[:2] for u in self.users.get(val, [])]
+            if max_overlap(intervals + self.fixed.get(val, [])) > cap:
+                return False
+        return True
+
+    def check(self, vals):
+        '''Sweep the intervals of the variables taking each value'''
+        active = dict()
+        for val, ivs in self.fixed.items():
+            active[val] = list(ivs)
+        for i, val in enumerate(vals):
+            if val in self.capacities:
+                active.setdefault(val, []).append(self.intervals[self.scope[i]])
+        for val, ivs in active.items():
+            if max_overlap(ivs) > self.capacities[val]:
+                return False
+        return True
+
+    def has_support(self, var, val):
+        '''var = val is supported if, over var's interval, the peak
+           number of other variables forced to val (assigned, or with 
+           val as the only value left in their current domain) leaves 
+           room for one more use'''
+        if not val in self.capacities:
+            return True
+        start, end = self.intervals[var]
+        if start >= end:
+            #an empty interval is never active
+            return True
+        cap = self.capacities[val]
+        users = self.users.get(val, [])
+        fixed = self.fixed.get(val, [])
+        if len(users) + len(fixed) <= cap:
+            return True
+
+        forced = []
+        for s, e in fixed:
+            if s < end and e > start:
+                forced.append((max(s, start), min(e, end)))
+        for s, e, v in users:
+            if s >= end:
+                break
+            if e <= start or v is var:
+                continue
+            if v.cur_domain_size() == 1 and v.in_cur_domain(val):
+                forced.append((max(s, start), min(e, end)))
+        if len(forced) < cap:
+            return True
+        return max_overlap(forced) < cap
+
+class AllDifferentConstraint(IntensionalConstraint):
+    '''Constraint that all variables of the scope take different
+       values.
+
+       Support is computed for all variable/value pairs at once using
+       Regin's algorithm: find a maximum matching between variables and
+       values; var = val is supported iff the edge (var, val) belongs to
+       some maximum matching covering every variable, i.e., it is in the
+       matching, lies on an alternating cycle, or lies on an even
+       alternating path starting at a free value. The result is cached
+       until the current domains change.'''
+
+    def __init__(self, name, scope):
+        IntensionalConstraint.__init__(self, name, scope)
+        self.match = dict()         #variable -> value of last matching
+        self.doms = None            #current domains supports computed for
+        self.supported = set()      #supported (variable, value) pairs
+
+    def check(self, vals):
+        return len(set(vals)) == len(vals)
+
+    def can_fix(self, var):
+        return False
+
+    def is_entailed(self):
+        '''Entailed if no two variables share a domain value'''
+        seen = set()
+        for v in self.scope:
+            for val in set(v.domain()):
+                if val in seen:
+                    return False
+                seen.add(val)
+        return True
+
+    def cost(self):
+        '''One matching and SCC computation per change of domains'''
+        return len(self.scope) * sum(v.domain_size() for v in self.scope)
+
+    def has_support(self, var, val):
+        doms = [tuple(v.cur_domain()) for v in self.scope]
+        if doms != self.doms:
+            self.doms = doms
+            self.supported = self.compute_supports(doms)
+        return (var, val) in self.supported
+
+    def compute_supports(self, doms):
+        '''Return the set of (variable, value) pairs supported given the 
+           current domains doms (ordered as the scope)'''
+        n = len(self.scope)
+        owner = dict()              #value -> index of variable matched to it
+        match = [None] * n
+        #keep what we can of the previous matching
+        for i, var in enumerate(self.scope):
+            val = self.match.get(var)
+            if val is not None and val in doms[i] and not val in owner:
+                match[i] = val
+                owner[val] = i
+
+        for i in range(n):
+            if match[i] is None and not self.augment(i, doms, match, owner, set()):
+                self.match = dict()
+                return set()
+        self.match = dict(zip(self.scope, match))
+
+        #Graph: unmatched edges value -> variable, matched edges
+        #variable -> value. Variable nodes are (0, index), value nodes
+        #are (1, value).
+        succ = dict()
+        for i in range(n):
+            succ[(0, i)] = [(1, match[i])]
+            for val in doms[i]:
+                if val != match[i]:
+                    succ.setdefault((1, val), []).append((0, i))
+
+        #nodes reachable from a free (unmatched) value
+        stack = [node for node in succ if node[0] == 1 and not node[1] in owner]
+        reached = set(stack)
+        while stack:
+            node = stack.pop()
+            for nxt in succ.get(node, []):
+                if not nxt in reached:
+                    reached.add(nxt)
+                    stack.append(nxt)
+
+        comp = strongly_connected(succ)
+        supported = set()
+        for i, var in enumerate(self.scope):
+            for val in doms[i]:
+                if (val == match[i] or (1, val) in reached 
+                    or comp[(1, val)] == comp[(0, i)]):
+                    supported.add((var, val))
+        return supported
+
+    def augment(self, i, doms, match, owner, seen):
+        '''Try to find an augmenting path from unmatched variable i
+           (Kuhn's algorithm), updating match/owner if found'''
+        for val in doms[i]:
+            if val in seen:
+                continue
+            seen.add(val)
+            j = owner.get(val)
+            if j is None or self.augment(j, doms, match, owner, seen):
+                match[i] = val
+                owner[val] = i
+                return True
+        return False
+
+class ObjectiveConstraint(IntensionalConstraint):
+    '''An objective to minimize (see BT.minimize), posted as a
+       constraint so that the propagators prune with it: once a
+       solution of value bound is known, only assignments whose value
+       is strictly below bound satisfy it. Before that (bound is None)
+       it is always satisfied.
+
+       Either pass function, taking the list of values of a complete
+       assignment (ordered as the scope) and returning its objective,
+       or subclass and override value. Subclasses should also override
+       lower_bound, an optimistic estimate of the value of any
+       assignment extending the current domains with var = val: the
+       default one knows nothing until the scope is fully assigned.'''
+
+    def __init__(self, name, scope, function=None):
+        IntensionalConstraint.__init__(self, name, scope)
+        self.function = function
+        self.bound = None
+
+    def value(self, vals):
+        '''Apply the function to the list of values'''
+        return self.function(vals)
+
+    def lower_bound(self, var, val):
+        return float('-inf')
+
+    def check(self, vals):
+        return self.bound is None or self.value(vals) < self.bound
+
+    def has_support(self, var, val):
+        if self.bound is None:
+            return True
+        if all(v is var or v.cur_domain_size() == 1 for v in self.scope):
+            vals = [val if v is var else v.cur_domain()[0] for v in self.scope]
+            return self.value(vals) < self.bound
+        return self.lower_bound(var, val) < self.bound
+
+    def is_entailed(self):
+        '''The bound tightens during search'''
+        return False
+
+    def cost(self):
+        '''lower_bound usually looks at the whole scope'''
+        return len(self.scope) * sum(v.domain_size() for v in self.scope)
+
+class LoadObjective(ObjectiveConstraint):
+    '''Base of objectives over the load of each of the given values,
+       i.e., the number of variables of the scope taking it, plus 
+       initial[val] (e.g., for variables removed by presolving).'''
+
+    def __init__(self, name, scope, values, initial=None):
+        ObjectiveConstraint.__init__(self, name, scope)
+        self.values = list(values)
+        self.initial = dict() if initial is None else dict(initial)
+
+    def loads(self, vals):
+        load = dict((val, self.initial.get(val, 0)) for val in self.values)
+        for val in vals:
+            if val in load:
+                load[val] = load[val] + 1
+        return load
+
+    def load_bounds(self, var, val):
+        '''Return dictionaries of the least and greatest possible load
+           of each value given the current domains with var = val: the
+           variables with a single value left count towards the least,
+           those with the value in their domain towards the greatest'''
+        low = dict((v, self.initial.get(v, 0)) for v in self.values)
+        high = dict(low)
+        for v in self.scope:
+            dom = [val] if v is var else v.cur_domain()
+            for x in dom:
+                if x in high:
+                    high[x] = high[x] + 1
+            if len(dom) == 1 and dom[0] in low:
+                low[dom[0]] = low[dom[0]] + 1
+        return low, high
+
+class LoadImbalanceObjective(LoadObjective):
+    '''Difference between the greatest and the least load'''
+
+    def value(self, vals):
+        load = self.loads(vals).values()
+        return max(load) - min(load) if load else 0
+
+    def lower_bound(self, var, val):
+        '''The greatest load is at least the greatest least load and
+           the average load the variables must make up, the least load
+           at most the least greatest load and the average they can'''
+        low, high = self.load_bounds(var, val)
+        if not low:
+            return 0
+        k = len(self.values)
+        forced = sum(self.initial.get(x, 0) for x in self.values)
+        possible = forced
+        for v in self.scope:
+            dom = [val] if v is var else v.cur_domain()
+            inside = [x for x in dom if x in low]
+            if len(inside) == len(dom):
+                forced = forced + 1
+            if inside:
+                possible = possible + 1
+        most = max(max(low.values()), -(-forced // k))
+        least = min(min(high.values()), possible // k)
+        return most - least
+
+class OvertimeObjective(LoadObjective):
+    '''Total load in excess of each value's regular load, given by
+       the dictionary regular (values not in it have no limit)'''
+
+    def __init__(self, name, scope, regular, initial=None):
+        LoadObjective.__init__(self, name, scope, list(regular.keys()), initial)
+        self.regular = dict(regular)
+
+    def value(self, vals):
+        load = self.loads(vals)
+        return sum(max(0, load[val] - self.regular[val]) for val in self.values)
+
+    def lower_bound(self, var, val):
+        '''The larger of the overtime of the least loads, and the total
+           load the variables with only these values left must make up
+           beyond the regular loads that can still be used'''
+        low, high = self.load_bounds(var, val)
+        each = sum(max(0, low[x] - self.regular[x]) for x in self.values)
+        total = sum(self.initial.get(x, 0) for x in self.values)
+        for v in self.scope:
+            dom = [val] if v is var else v.cur_domain()
+            if all(x in self.regular for x in dom):
+                total = total + 1
+        spare = sum(min(self.regular[x], high[x]) for x in self.values)
+        return max(each, total - spare)
+
+class PenaltyObjective(ObjectiveConstraint):
+    '''Sum of penalty(var, val) over the scope, plus a constant offset
+       (e.g., the penalties of variables removed by presolving)'''
+
+    def __init__(self, name, scope, penalty, offset=0):
+        ObjectiveConstraint.__init__(self, name, scope)
+        self.penalty = penalty
+        self.offset = offset
+
+    def value(self, vals):
+        return self.offset + sum(self.penalty(v, val) for v, val in zip(self.scope, vals))
+
+    def lower_bound(self, var, val):
+        total = self.offset + self.penalty(var, val)
+        for v in self.scope:
+            if v is not var:
+                total = total + min(self.penalty(v, x) for x in v.cur_domain())
+        return total
+
+def strongly_connected(succ):
+    '''Return a dictionary mapping each node of the graph succ (node ->
+       list of successor nodes) to the number of its strongly connected
+       component (iterative Tarjan)'''
+    index = dict()
+    low = dict()
+    comp = dict()
+    onstack = set()
+    stack = []
+    count = 0
+    for root in succ:
+        if root in index:
+            continue
+        work = [(root, 0)]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        onstack.add(root)
+        while work:
+            node, k = work[-1]
+            nxts = succ.get(node, [])
+            if k < len(nxts):
+                work[-1] = (node, k + 1)
+                nxt = nxts[k]
+                if not nxt in index:
+                    index[nxt] = low[nxt] = len(index)
+                    stack.append(nxt)
+                    onstack.add(nxt)
+                    work.append((nxt, 0))
+                elif nxt in onstack:
+                    low[node] = min(low[node], index[nxt])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        top = stack.pop()
+                        onstack.discard(top)
+                        comp[top] = count
+                        if top == node:
+                            break
+                    count = count + 1
+    return comp
+
+def filtered_product(domains, predicate):
+    '''Generate, one at a time, the tuples of the cartesian product of
+       domains (a list of lists of values) for which predicate(tuple) is
+       true. Rejected tuples are never kept.'''
+    n = len(domains)
+    if n == 0:
+        if predicate(()):
+            yield ()
+        return
+    prefix = []
+    iters = [iter(domains[0])]
+    while iters:
+        try:
+            val = next(iters[-1])
+        except StopIteration:
+            iters.pop()
+            if prefix:
+                prefix.pop()
+            continue
+        prefix.append(val)
+        k = len(prefix)
+        if k == n:
+            t = tuple(prefix)
+            if predicate(t):
+                yield t
+            prefix.pop()
+        else:
+            iters.append(iter(domains[k]))
+
+def max_overlap(intervals):
+    '''Return the largest number of [start, end) intervals covering a
+       single point. An interval ending at t does not overlap one 
+       starting at t.'''
+    events = []
+    for start, end in intervals:
+        if start < end:
+            events.append((start, 1))
+            events.append((end, -1))
+    events.sort()
+    n = 0
+    peak = 0
+    for t, d in events:
+        n = n + d
+        if n > peak:
+            peak = n
+    return peak
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -310,6 +1388,17 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        #set by bt_search to the Trail propagators should record
+        #their prunings on (None outside of search)
+        self.trail = None
+        #propagators set this to the constraint that caused a dead end
+        self.last_conflict = None
+        #set by bt_search to a PropagationQueue the propagators can reuse
+        self.queue = None
+        #set when presolving shows the CSP has no solution
+        self.infeasible = False
+        #variables removed by eliminate_fixed_vars -> their value
+        self.fixed = dict()
         for v in vars:
             self.add_var(v)
 
@@ -327,7 +1416,7 @@ class CSP:
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
@@ -337,6 +1426,77 @@ class CSP:
                 self.vars_to_cons[v].append(c)
             self.cons.append(c)
 
+    def eliminate_fixed_vars(self):
+        '''Presolve: remove from the CSP every variable whose domain has
+           a single value, provided all of its constraints can fold the
+           value in as a constant (see Constraint.fix_var). The variable
+           is left assigned to that value (and recorded in fixed, so 
+           solutions still include it). Constraints left with an
+           empty scope are removed; if one of them is violated, or the
+           constants folded into a constraint violate it on their own
+           (see Constraint.fixed_part_violated), the CSP is marked 
+           infeasible. Returns the number of variables removed.'''
+        removed = 0
+        for v in list(self.vars):
+            if v.domain_size() != 1 or v.is_assigned():
+                continue
+            cons = self.vars_to_cons[v]
+            if not all(c.can_fix(v) for c in cons):
+                continue
+            val = v.dom[0]
+            for c in cons:
+                c.fix_var(v, val)
+            self.vars.remove(v)
+            del self.vars_to_cons[v]
+            v.assign(val)
+            self.fixed[v] = val
+            removed = removed + 1
+
+        for c in list(self.cons):
+            if c.fixed_part_violated():
+                self.infeasible = True
+            if not c.scope:
+                if not c.check([]):
+                    self.infeasible = True
+                self.cons.remove(c)
+        return removed
+
+    def remove_constraint(self, c):
+        '''Remove constraint c from the CSP. It stops watching its
+           variables, so it should not be used afterwards.'''
+        self.cons.remove(c)
+        for v in set(c.scope):
+            if c in self.vars_to_cons[v]:
+                self.vars_to_cons[v] = [c2 for c2 in self.vars_to_cons[v] if not c2 is c]
+            while c in v.watchers:
+                v.watchers.remove(c)
+
+    def drop_entailed_constraints(self):
+        '''Presolve: remove the constraints that can never be violated
+           given the variable domains (see Constraint.is_entailed), and
+           each AllDifferentConstraint whose scope is contained in the
+           scope of another one. Returns the number of constraints
+           removed.'''
+        dropped = [c for c in self.cons if c.is_entailed()]
+        alldiff = [c for c in self.cons if isinstance(c, AllDifferentConstraint)
+                   and not c in dropped]
+        alldiff.sort(key=lambda c: len(c.scope))
+        for i, c in enumerate(alldiff):
+            scope = set(c.scope)
+            for c2 in alldiff[i+1:]:
+                if scope <= set(c2.scope):
+                    dropped.append(c)
+                    break
+        for c in dropped:
+            self.remove_constraint(c)
+        return len(dropped)
+
+    def set_trail(self, trail):
+        '''Make trail the Trail of the CSP and of all its constraints'''
+        self.trail = trail
+        for c in self.cons:
+            c.trail = trail
+
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
         return self.cons
@@ -355,16 +1515,238 @@ class CSP:
         print("   Constraints = ", self.cons)
 
 
-    def print_soln(self):
-        print("CSP", self.name, " Assignments = ")
+    def format_soln(self, assignment=None):
+        '''Return the text print_soln prints: the value of each variable
+           in assignment (a dictionary as in SearchResult), or its 
+           assigned value if no assignment is given'''
+        lines = ["CSP {}  Assignments = ".format(self.name)]
+        vals = []
         for v in self.vars:
-            print(v, " = ", v.get_assigned_value(), "    ", end='')
-        print("")
+            val = v.get_assigned_value() if assignment is None else assignment.get(v)
+            vals.append("{}  =  {}     ".format(v, val))
+        lines.append("".join(vals))
+        return "\n".join(lines)
+
+    def print_soln(self):
+        print(self.format_soln())
 
 ########################################################
 # Backtracking Routine                                 #
 ########################################################
 
+class Trail:
+    '''Stack of the (variable, value) prunings made during search,
+       shared by bt_search and the propagators. Before propagating a
+       decision bt_search marks the current height of the stack; to
+       backtrack it restores every pruning above the last mark and
+       drops the mark.
+
+       Constraints can also save other state that must be restored on
+       backtracking (a dictionary entry) on a second stack that is 
+       marked and undone with the prunings.'''
+
+    def __init__(self):
+        self.entries = []
+        self.saved = []
+        self.marks = []
+
+    def push(self, var, val):
+        '''Record that val has been pruned from var's current domain'''
+        self.entries.append((var, val))
+
+    def save(self, d, key, old):
+        '''Record that d[key] was old (before being changed)'''
+        self.saved.append((d, key, old))
+
+    def mark(self):
+        '''Start a new level'''
+        self.marks.append((len(self.entries), len(self.saved)))
+
+    def undo(self):
+        '''Restore the prunings and saved state since the last mark and
+           remove the mark'''
+        m, n = self.marks.pop()
+        entries = self.entries
+        while len(entries) > m:
+            var, val = entries.pop()
+            var.unprune_value(val)
+        saved = self.saved
+        while len(saved) > n:
+            d, key, old = saved.pop()
+            d[key] = old
+
+    def clear(self):
+        '''Undo every level'''
+        while self.marks:
+            self.undo()
+
+    def size(self):
+        '''Number of prunings on the trail'''
+        return len(self.entries)
+
+    def top(self):
+        '''List of prunings made since the last mark'''
+        return self.entries[self.marks[-1][0]:]
+
+class PropagationQueue:
+    '''Queue of constraints waiting to be revised by GAC. A constraint
+       is never in the queue twice, and the constraint with the smallest
+       cost() comes out first (ties in order of arrival).'''
+
+    def __init__(self):
+        self.heap = []
+        self.members = set()
+        self.count = 0
+
+    def __len__(self):
+        return len(self.members)
+
+    def push(self, c):
+        '''Add c unless it is already waiting'''
+        if not c in self.members:
+            self.members.add(c)
+            self.count = self.count + 1
+            heapq.heappush(self.heap, (c.cost(), self.count, c))
+
+    def extend(self, cons, skip=None):
+        '''Add each constraint in cons except skip'''
+        for c in cons:
+            if not c is skip:
+                self.push(c)
+
+    def pop(self):
+        '''Remove and return the cheapest waiting constraint'''
+        c = heapq.heappop(self.heap)[2]
+        self.members.remove(c)
+        return c
+
+    def clear(self):
+        self.heap = []
+        self.members = set()
+
+class VarHeap:
+    '''Priority queue of the unassigned variables, smallest key(var)
+       first. Keys change as values are pruned and restored; call
+       update(var) after a variable's key decreases so that it is
+       pushed again. Out of date entries are skipped (or pushed again
+       with the current key) when they reach the top.'''
+
+    def __init__(self, vars, key):
+        self.key = key
+        self.members = set()
+        self.heap = []
+        for v in vars:
+            self.push(v)
+
+    def __len__(self):
+        return len(self.members)
+
+    def push(self, var):
+        '''Add var to the queue'''
+        self.members.add(var)
+        heapq.heappush(self.heap, (self.key(var), var))
+
+    def update(self, var):
+        '''Reposition var after its key decreased'''
+        if var in self.members:
+            heapq.heappush(self.heap, (self.key(var), var))
+            if len(self.heap) > 4 * len(self.members) + 32:
+                self.heap = [(self.key(v), v) for v in self.members]
+                heapq.heapify(self.heap)
+
+    def pop(self):
+        '''Remove and return the variable with the smallest key'''
+        while self.heap:
+            k, var = heapq.heappop(self.heap)
+            if var in self.members:
+                current = self.key(var)
+                if k == current:
+                    self.members.remove(var)
+                    return var
+                heapq.heappush(self.heap, (current, var))
+        return None
+
+SAT = 'SAT'
+UNSAT = 'UNSAT'
+UNKNOWN = 'UNKNOWN'
+
+class SearchResult:
+    '''The outcome of BT.solve. status is SAT (a solution was found),
+       UNSAT (there is none) or UNKNOWN (the search stopped first, 
+       reason says why: 'nodes', 'fails', 'time', 'cancelled' or 
+       'limit', see BT.count_solutions; BT.minimize also sets it when
+       it stops with a solution that may not be optimal).
+       assignment maps each variable of the CSP to its value in the 
+       solution, including variables removed by presolving (None unless
+       SAT). The search statistics are kept as nDecisions, nPrunings,
+       nFails and runtime (CPU seconds).'''
+
+    def __init__(self, status, assignment=None, reason=None):
+        self.status = status
+        self.assignment = assignment
+        self.reason = reason
+        self.nDecisions = 0
+        self.nPrunings = 0
+        self.nFails = 0
+        self.runtime = 0
+        self.nSolutions = 0 #number of solutions found (see BT.count_solutions)
+        self.config = None  #set by portfolio_solve
+        self.objective = None #value of the assignment (see BT.minimize)
+
+    def stats(self):
+        '''Return the statistics as a dictionary'''
+        return {'decisions': self.nDecisions, 'prunings': self.nPrunings,
+                'fails': self.nFails, 'runtime': self.runtime}
+
+    def __repr__(self):
+        return "SearchResult({}, reason={}, {})".format(self.status, self.reason, self.stats())
+
+class CancelToken:
+    '''Lets another thread stop a search: pass the token to BT.solve
+       (or bt_search) and call cancel(). The search checks the token 
+       before each variable assignment, so it stops soon after with
+       status UNKNOWN. An event object with set/is_set methods (e.g., 
+       a multiprocessing Event, to cancel a search in another process) 
+       can be given to use instead of a threading Event.'''
+
+    def __init__(self, event=None):
+        self.event = threading.Event() if event is None else event
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+class ConsoleReporter:
+    '''Opt-in console output: give one to BT to have the outcome of
+       each search printed along with the solution and the search
+       statistics. Models can print their own messages with message.
+       Everything goes through message, so a subclass can send it 
+       elsewhere (e.g., to logging) by overriding message.'''
+
+    def message(self, text):
+        print(text)
+
+    def search_finished(self, solver, result):
+        '''Called by BT.solve with the SearchResult of the search'''
+        name = solver.csp.name
+        if result.status == UNSAT:
+            if result.nDecisions == 0:
+                self.message("CSP{} detected contradiction at root".format(name))
+            self.message("CSP{} unsolved. Has no solutions".format(name))
+        elif result.status == UNKNOWN:
+            self.message("CSP{} unsolved. Search stopped ({})".format(name, result.reason))
+        else:
+            self.message("CSP {} solved. CPU Time used = {}".format(name, result.runtime))
+            if result.objective is not None:
+                optimal = "optimal" if result.reason is None else "best found, search stopped ({})".format(result.reason)
+                self.message("Objective value = {} ({})".format(result.objective, optimal))
+            if result.assignment is not None:
+                self.message(solver.csp.format_soln(result.assignment))
+        self.message("bt_search finished")
+        self.message(solver.stats_summary())
+
 class BT:
     '''use a class to encapsulate things like statistics
        and bookeeping for pruning/unpruning variabel domains
@@ -374,14 +1756,32 @@ class BT:
        kind or propagator function to obtain plain backtracking
        forward-checking or gac'''
 
-    def __init__(self, csp):
-        '''csp == CSP object specifying the CSP to be solved'''
+    def __init__(self, csp, reporter=None, value_order='domain', seed=None):
+        '''csp == CSP object specifying the CSP to be solved
+           reporter == object to tell the outcome of each search (see
+           ConsoleReporter), None to print nothing
+           value_order == order to try the values of a variable in:
+              'domain' (the order of its domain), 'reverse' or 'random'
+           seed == seed for the 'random' value order; if given it also
+              breaks the remaining ties between variables at random'''
 
         self.csp = csp
+        self.reporter = reporter
+        self.value_order = value_order
+        self.seed = seed
+        self.rng = random.Random(seed)
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
+        self.nFails = 0     #nFails is the number of dead ends found by the propagator
         unasgn_vars = list() #used to track unassigned variables
+        #search budgets (see solve), None for no limit
+        self.node_limit = None
+        self.fail_limit = None
+        self.deadline = None
+        self.cancel = None
+        self.stop_reason = None
+        self.frontier = []  #subtrees not searched when the budget ran out
         self.TRACE = False
         self.runtime = 0
 
@@ -398,11 +1798,15 @@ class BT:
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nFails = 0
         self.runtime = 0
 
+    def stats_summary(self):
+        return "Search made {} variable assignments and pruned {} variable values".format(
+            self.nDecisions, self.nPrunings)
+
     def print_stats(self):
-        print("Search made {} variable assignments and pruned {} variable values".format(
-            self.nDecisions, self.nPrunings))
+        print(self.stats_summary())
 
     def restoreValues(self,prunings):
         '''Restore list of values to variable domains
@@ -417,29 +1821,73 @@ class BT:
                 var.unassign()
             var.restore_curdom()
 
+    def var_key(self, var):
+        '''Heuristic key for variable selection: smallest current domain
+           (MRV) first, ties broken by dom/wdeg (the larger the summed 
+           weight of the variable's constraints the better), then by 
+           degree, then by position in the CSP'''
+        return (var.cur_domain_size(), -self.wdeg[var], 
+                -len(self.csp.vars_to_cons[var]), self.order[var])
+
+    def order_values(self, var):
+        '''Return the current domain of var in the order the values
+           are to be tried (see value_order)'''
+        vals = var.cur_domain()
+        if self.value_order == 'reverse':
+            vals.reverse()
+        elif self.value_order == 'random':
+            self.rng.shuffle(vals)
+        return vals
+
     def extractMRVvar(self):
-        '''Remove variable with minimum sized cur domain from list of
-           unassigned vars. Would be faster to use heap...but this is
-           not production code.
+        '''Remove variable with minimum sized cur domain from the heap of
+           unassigned vars (see var_key for tie breaking).
         '''
-
-        md = -1
-        mv = None
-        for v in self.unasgn_vars:
-            if md < 0:
-                md = v.cur_domain_size()
-                mv = v
-            elif v.cur_domain_size() < md:
-                md = v.cur_domain_size()
-                mv = v
-        self.unasgn_vars.remove(mv)
-        return mv
+        return self.unasgn_vars.pop()
 
     def restoreUnasgnVar(self, var):
-        '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
+        '''Add variable back to heap of unassigned vars'''
+        self.unasgn_vars.push(var)
+
+    def update_unasgn_vars(self, prunings, height):
+        '''Reposition the variables that had values pruned, i.e., those
+           in prunings and those on the trail above height'''
+        for var, val in prunings:
+            self.unasgn_vars.update(var)
+        entries = self.trail.entries
+        for i in range(height, len(entries)):
+            self.unasgn_vars.update(entries[i][0])
+
+    def bump_conflict(self):
+        '''Increase the weight of the constraint the propagator reported
+           as the cause of the last dead end'''
+        c = self.csp.last_conflict
+        if c is None:
+            return
+        self.csp.last_conflict = None
+        c.weight = c.weight + 1
+        for v in c.scope:
+            if v in self.wdeg:
+                self.wdeg[v] = self.wdeg[v] + 1
+                self.unasgn_vars.update(v)
         
-    def bt_search(self,propagator):
+    def out_of_budget(self):
+        '''Return True (and set stop_reason) if the search should stop
+           because a limit was reached or it was cancelled'''
+        if self.node_limit is not None and self.nDecisions >= self.node_limit:
+            self.stop_reason = 'nodes'
+        elif self.fail_limit is not None and self.nFails >= self.fail_limit:
+            self.stop_reason = 'fails'
+        elif self.deadline is not None and time.monotonic() > self.deadline:
+            self.stop_reason = 'time'
+        elif self.cancel is not None and self.cancel.is_cancelled():
+            self.stop_reason = 'cancelled'
+        else:
+            return False
+        return True
+
+    def bt_search(self, propagator, node_limit=None, time_limit=None, 
+                  fail_limit=None, cancel=None):
         '''Try to solve the CSP using specified propagator routine
 
            propagator == a function with the following template
@@ -469,82 +1917,695 @@ class BT:
            values when it undoes a variable assignment.
 
            NOTE propagator SHOULD NOT prune a value that has already been 
-           pruned! Nor should it prune a value twice'''
+           pruned! Nor should it prune a value twice
+
+           While searching, csp.trail is a Trail object. Propagators
+           can push their prunings on it instead of returning them
+           in the list; bt_search restores both. csp.queue is a 
+           PropagationQueue GAC propagators can use.
+
+           The search is done by bt_iterate, so deep searches do not
+           hit Python's recursion limit. See solve for the limits.
+
+           Returns True if a solution was found (the variables are left
+           assigned to it), False if there is none, and None if a limit
+           was reached first. Use solve to get the solution and the 
+           statistics as a SearchResult.'''
+
+        result = self.solve(propagator, node_limit, time_limit, fail_limit, cancel)
+        return {SAT: True, UNSAT: False, UNKNOWN: None}[result.status]
+
+    def solve(self, propagator, node_limit=None, time_limit=None, 
+              fail_limit=None, cancel=None, assumptions=()):
+        '''Search as bt_search does and return a SearchResult (which
+           is also given to the reporter, if any). The search stops 
+           with status UNKNOWN after node_limit variable assignments,
+           fail_limit dead ends, time_limit seconds (wall clock) or when
+           the CancelToken cancel is cancelled, whichever comes first.
+
+           assumptions is a list of (var, val) pairs: only the solutions
+           with var = val for each pair are searched for (the other
+           values are pruned before the initial propagation).'''
+
+        status, prunings = self.start_search(propagator, node_limit, time_limit,
+                                             fail_limit, cancel, assumptions)
+        if status:
+            status = self.bt_iterate(propagator)
+        assignment = self.current_solution() if status else None
+        self.end_search(prunings)
+
+        if status:
+            result = SearchResult(SAT, assignment)
+            result.nSolutions = 1
+        elif status is None:
+            result = SearchResult(UNKNOWN, reason=self.stop_reason)
+        else:
+            result = SearchResult(UNSAT)
+        return self.finish_result(result)
+
+    def solutions(self, propagator, limit=None, node_limit=None, time_limit=None,
+                  fail_limit=None, cancel=None):
+        '''Generator of the solutions of the CSP, each a dictionary
+           mapping the variables to their values (as for SearchResult).
+           Each solution is yielded as soon as the search finds it, and
+           the search continues when the next one is asked for. Yields
+           at most limit solutions, and stops at the limits of solve 
+           (check stop_reason afterwards to tell if every solution was
+           found: it is 'limit' if there are more than limit).
+           The variables are unassigned once the generator finishes or 
+           is closed.'''
+        status, prunings = self.start_search(propagator, node_limit, time_limit,
+                                             fail_limit, cancel)
+        n = 0
+        try:
+            if status:
+                for _ in self.bt_generate(propagator):
+                    if limit is not None and n >= limit:
+                        self.stop_reason = 'limit'
+                        break
+                    n = n + 1
+                    yield self.current_solution()
+        finally:
+            self.end_search(prunings)
+            self.restore_all_variable_domains()
+
+    def count_solutions(self, propagator, limit=None, node_limit=None, 
+                        time_limit=None, fail_limit=None, cancel=None):
+        '''Count the solutions of the CSP without building them (the
+           search is that of solutions). Returns a SearchResult with the
+           count in nSolutions: its status is SAT or UNSAT if all of the
+           solutions were counted, and UNKNOWN if the search stopped 
+           first (reason 'limit' if there are more than limit).'''
+        status, prunings = self.start_search(propagator, node_limit, time_limit,
+                                             fail_limit, cancel)
+        n = 0
+        if status:
+            for _ in self.bt_generate(propagator):
+                if limit is not None and n >= limit:
+                    self.stop_reason = 'limit'
+                    break
+                n = n + 1
+        self.end_search(prunings)
+        self.restore_all_variable_domains()
 
+        if self.stop_reason is not None:
+            result = SearchResult(UNKNOWN, reason=self.stop_reason)
+        else:
+            result = SearchResult(SAT if n > 0 else UNSAT)
+        result.nSolutions = n
+        return self.finish_result(result)
+
+    def minimize(self, propagator, objective, node_limit=None, time_limit=None,
+                 fail_limit=None, cancel=None):
+        '''Branch and bound: search for a solution minimizing the
+           ObjectiveConstraint objective (added to the CSP for the 
+           search if it is not already there). Each solution found becomes the bound the
+           following ones must improve on, and the propagators prune 
+           the assignments whose objective cannot beat it.
+
+           Returns a SearchResult with the best solution found and its
+           value in objective. If the search finished, the solution is
+           optimal (status SAT, reason None) or there is none (UNSAT).
+           If it stopped at one of the limits of solve, status is SAT 
+           with the reason set when a solution was found (it is the best
+           so far, not necessarily optimal), otherwise UNKNOWN.'''
+        added = not objective in self.csp.cons
+        if added:
+            #watch the scope again if a previous search removed it
+            for v in objective.scope:
+                if not objective in v.watchers:
+                    v.add_watcher(objective)
+            objective.n_unasgn = sum(1 for v in objective.scope if not v.is_assigned())
+            self.csp.add_constraint(objective)
+        objective.bound = None
+        best = None
+        n = 0
+        status, prunings = self.start_search(propagator, node_limit, time_limit,
+                                             fail_limit, cancel)
+        try:
+            if status:
+                for _ in self.bt_generate(propagator):
+                    value = objective.value([v.get_assigned_value() for v in objective.scope])
+                    if objective.bound is not None and value >= objective.bound:
+                        continue
+                    n = n + 1
+                    best = self.current_solution()
+                    objective.bound = value
+                    if self.reporter is not None:
+                        self.reporter.message("Solution of value {} found".format(value))
+        finally:
+            self.end_search(prunings)
+            self.restore_all_variable_domains()
+            value = objective.bound
+            objective.bound = None
+            if added:
+                self.csp.remove_constraint(objective)
+
+        if best is not None:
+            result = SearchResult(SAT, best, self.stop_reason)
+            result.objective = value
+        elif self.stop_reason is not None:
+            result = SearchResult(UNKNOWN, reason=self.stop_reason)
+        else:
+            result = SearchResult(UNSAT)
+        result.nSolutions = n
+        return self.finish_result(result)
+
+    def start_search(self, propagator, node_limit=None, time_limit=None, 
+                     fail_limit=None, cancel=None, assumptions=()):
+        '''Internal routine for solve, solutions, count_solutions and
+           minimize. Set up the search and do the initial propagation. Returns its
+           status and the prunings to give to end_search.'''
         self.clear_stats()
-        stime = time.process_time()
+        self.stime = time.process_time()
+        self.node_limit = node_limit
+        self.fail_limit = fail_limit
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit
+        self.cancel = cancel
+        self.stop_reason = None
+        self.frontier = []
 
         self.restore_all_variable_domains()
+        self.trail = Trail()
+        self.csp.set_trail(self.trail)
+        self.csp.queue = PropagationQueue()
         
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
-
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
+        self.rng = random.Random(self.seed)
+        positions = list(range(len(self.csp.vars)))
+        if self.seed is not None:
+            self.rng.shuffle(positions)
+        self.order = dict()
+        self.wdeg = dict()
+        for i, v in enumerate(self.csp.vars):
+            self.order[v] = positions[i]
+            self.wdeg[v] = sum(c.weight for c in self.csp.vars_to_cons[v])
+        self.unasgn_vars = VarHeap([v for v in self.csp.vars if not v.is_assigned()],
+                                   self.var_key)
+
+        self.trail.mark()
+        self.csp.last_conflict = None
+        status, prunings = not self.csp.infeasible, []
+        for var, val in assumptions:
+            if not var.in_cur_domain(val):
+                status = False
+                break
+            for other in var.cur_domain():
+                if other != val:
+                    var.prune_value(other)
+                    self.trail.push(var, other)
+        if status:
+            status, prunings = propagator(self.csp) #initial propagate no assigned variables.
+        self.nPrunings = self.nPrunings + len(prunings) + self.trail.size()
+        self.update_unasgn_vars(prunings, 0)
 
         if self.TRACE:
             print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
+            print("Root Prunings: ", prunings + self.trail.top())
 
         if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
-        else:
-            status = self.bt_recurse(propagator, 1)   #now do recursive search
-
+            self.nFails = self.nFails + 1
+        return status, prunings
 
+    def end_search(self, prunings):
+        '''Internal routine: undo the initial propagation of 
+           start_search'''
         self.restoreValues(prunings)
-        if status == False:
-            print("CSP{} unsolved. Has no solutions".format(self.csp.name))
-        if status == True:
-            print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
-                                                             time.process_time() - stime))
-            self.csp.print_soln()
-
-        print("bt_search finished")
-        self.print_stats()
-
-    def bt_recurse(self, propagator, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
-
-        if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
-        if not self.unasgn_vars:
-            #all variables assigned
+        self.trail.clear()
+        self.csp.set_trail(None)
+        self.csp.queue = None
+        self.cancel = None
+        self.runtime = time.process_time() - self.stime
+
+    def current_solution(self):
+        '''Return the current (complete) assignment as a dictionary'''
+        assignment = dict(self.csp.fixed)
+        for v in self.csp.vars:
+            assignment[v] = v.get_assigned_value()
+        return assignment
+
+    def finish_result(self, result):
+        '''Internal routine: add the search statistics to result and
+           give it to the reporter'''
+        result.nDecisions = self.nDecisions
+        result.nPrunings = self.nPrunings
+        result.nFails = self.nFails
+        result.runtime = self.runtime
+        if self.reporter is not None:
+            self.reporter.search_finished(self, result)
+        return result
+
+    def solve_parallel(self, propagator, build, args, processes=None, 
+                       split_nodes=1000, time_limit=None):
+        '''Search as solve does, but split the search tree between a
+           pool of worker processes. Returns a SearchResult whose 
+           statistics are the totals over all workers (runtime is the 
+           total CPU time).
+
+           The tree is split into subproblems, each one fixing a few
+           variables to values (see _split_subproblem), and the workers
+           take the subproblems from a shared queue. A worker that has 
+           not finished a subproblem after split_nodes assignments 
+           gives the part of it not yet searched back to the queue, as
+           one subproblem per untried value on its search stack (see 
+           BT.untried), so idle workers get a share of the hard parts of
+           the tree and no search is repeated. The parts get twice the 
+           budget, so there are not too many of them.
+           Proving there is no solution needs every subproblem, while 
+           the first solution found stops the other workers.
+
+           build(*args) must build self.csp, as for portfolio_solve; the
+           workers use this BT's value_order and seed.'''
+        if self.csp.infeasible:
+            return self.solve(propagator)
+        stime = time.monotonic()
+        deadline = None if time_limit is None else stime + time_limit
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        #start with a few subproblems per worker
+        parts = [[]]
+        while 0 < len(parts) < 4 * processes:
+            more = _split_subproblem(self.csp, parts[0])
+            if more is None:
+                break
+            parts = parts[1:] + more
+
+        results = queue.Queue()
+        def failed(e):
+            results.put((UNKNOWN, None, 'error: {}'.format(e), (0, 0, 0, 0), None))
+        total = SearchResult(UNSAT)
+        answer = None
+        outstanding = 0
+        event = multiprocessing.Event()
+        pool = multiprocessing.Pool(processes, _worker_init, (build, args, event))
+        try:
+            for part in parts:
+                job = (part, propagator, self.value_order, self.seed, split_nodes, time_limit)
+                pool.apply_async(_subproblem_run, (job,), callback=results.put,
+                                 error_callback=failed)
+                outstanding = outstanding + 1
+            while outstanding > 0:
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                    status, values, reason, stats, more = results.get(timeout=timeout)
+                except queue.Empty:
+                    answer = (UNKNOWN, None, 'time')
+                    break
+                outstanding = outstanding - 1
+                total.nDecisions = total.nDecisions + stats[0]
+                total.nPrunings = total.nPrunings + stats[1]
+                total.nFails = total.nFails + stats[2]
+                total.runtime = total.runtime + stats[3]
+                if status == SAT:
+                    answer = (SAT, values, None)
+                    break
+                if status == UNKNOWN and more is None:
+                    answer = (UNKNOWN, None, reason)
+                    break
+                for part, budget in more or []:
+                    remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                    job = (part, propagator, self.value_order, self.seed, budget, remaining)
+                    pool.apply_async(_subproblem_run, (job,), callback=results.put,
+                                     error_callback=failed)
+                    outstanding = outstanding + 1
+        finally:
+            event.set()
+            pool.close()
+            pool.join()
+
+        if answer is not None:
+            total.status, values, total.reason = answer
+            if values is not None:
+                total.assignment = dict(self.csp.fixed)
+                for v, i in zip(self.csp.vars, values):
+                    total.assignment[v] = v.dom[i]
+        self.nDecisions = total.nDecisions
+        self.nPrunings = total.nPrunings
+        self.nFails = total.nFails
+        self.runtime = total.runtime
+        if self.reporter is not None:
+            self.reporter.search_finished(self, total)
+        return total
+
+    def bt_iterate(self, propagator):
+        '''Depth first search for a solution, with an explicit stack of
+           decisions instead of one Python frame per variable so deep 
+           searches do not hit Python's recursion limit (see 
+           bt_generate).
+
+           Return True if found solution, False if there is none and None
+           if the search ran out of budget first (see out_of_budget). 
+           Then the search is undone, as it is when there is no 
+           solution.'''
+        for _ in self.bt_generate(propagator):
             return True
-        else:
-            var = self.extractMRVvar()
-            if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
+        return None if self.stop_reason is not None else False
+
+    def bt_generate(self, propagator):
+        '''Generator doing the search of bt_iterate: it yields (with
+           all the variables assigned) each time a solution is found,
+           and goes on to look for the next one when resumed. Each
+           stack entry is [var, values to try, index of the next one,
+           prunings of the current one]. When there are no more
+           solutions, or the search runs out of budget, the search is
+           undone and the generator ends. In the latter case frontier 
+           is left with the part of the tree not yet searched, as a list
+           of subtrees, each a list of (var, val) decisions.'''
+
+        stack = []
+        descend = True
+        while True:
+            if descend:
+                if not self.unasgn_vars:
+                    #all variables assigned
+                    yield True
+                    if not stack:
+                        return
+                    descend = False
+                    continue
+                var = self.extractMRVvar()
+                frame = [var, self.order_values(var), 0, []]
+                stack.append(frame)
+                if self.TRACE:
+                    print('  ' * len(stack), "bt_iterate var = ", var)
+            else:
+                #undo the value of the variable on top of the stack
+                frame = stack[-1]
+                var = frame[0]
+                if self.TRACE:
+                    print('  ' * len(stack), "bt_iterate restoring ", frame[3] + self.trail.top())
+                self.restoreValues(frame[3])
+                self.trail.undo()
+                var.unassign()
 
-            for val in var.cur_domain():
+            if frame[2] == len(frame[1]):
+                #no values left, backtrack
+                self.restoreUnasgnVar(var)
+                stack.pop()
+                if not stack:
+                    return
+                descend = False
+                continue
+
+            if self.out_of_budget():
+                self.frontier = self.untried(stack)
+                self.restoreUnasgnVar(var)
+                stack.pop()
+                self.unwind(stack)
+                return
+
+            val = frame[1][frame[2]]
+            frame[2] = frame[2] + 1
+            if self.TRACE:
+                print('  ' * len(stack), "bt_iterate trying", var, "=", val)
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
 
-                var.assign(val)
-                self.nDecisions = self.nDecisions+1
+            self.trail.mark()
+            height = self.trail.size()
+            self.csp.last_conflict = None
+            status, prunings = propagator(self.csp, var)
+            frame[3] = prunings
+            self.nPrunings = self.nPrunings + len(prunings) + self.trail.size() - height
 
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+            if self.TRACE:
+                print('  ' * len(stack), "bt_iterate prop status = ", status)
+                print('  ' * len(stack), "bt_iterate prop pruned = ", prunings + self.trail.top())
+
+            if status:
+                self.update_unasgn_vars(prunings, height)
+                descend = True
+            else:
+                self.nFails = self.nFails + 1
+                self.bump_conflict()
+                descend = False
+
+    def untried(self, stack):
+        '''Return the subtrees of a bt_generate stack not yet searched:
+           each value still to try at each level, after the values
+           currently assigned at the levels above'''
+        subtrees = []
+        path = []
+        for var, vals, i, prunings in stack:
+            for val in vals[i:]:
+                subtrees.append(path + [(var, val)])
+            if i > 0:
+                path = path + [(var, vals[i - 1])]
+        return subtrees
+
+    def unwind(self, stack):
+        '''Undo the assignments of a bt_generate stack, all of whose 
+           variables are assigned'''
+        while stack:
+            var, vals, i, prunings = stack.pop()
+            self.restoreValues(prunings)
+            self.trail.undo()
+            var.unassign()
+            self.restoreUnasgnVar(var)
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+class QuickXplain:
+    '''Explain why a CSP has no solution: find a minimal subset of its
+       constraints that already has no solution, using Junker's
+       QuickXplain algorithm with BT search as the consistency check.
+
+       The constraints are given in groups (e.g., one group per family
+       of constraints of a model) and a minimal set of groups is found,
+       i.e., dropping any one of the groups returned leaves a CSP with a
+       solution. Each check solves a CSP over the same variables and a
+       subset of the constraints. QuickXplain makes O(k log(n/k))
+       checks to find k groups out of n, and max_checks bounds them:
+       when the budget runs out the remaining checks are taken to
+       succeed, so the groups returned still have no solution but may
+       not be minimal (complete is then False). Each check can also be
+       given a node_limit and a time_limit (see BT.solve); a check
+       stopped by them is taken to succeed in the same way.'''
+
+    def __init__(self, csp, propagator):
+        self.csp = csp
+        self.propagator = propagator
+        self.nChecks = 0    #number of consistency checks (BT searches)
+        self.complete = True
+        self.runtime = 0
 
-                if status:
-                    if self.bt_recurse(propagator, level+1):
-                        return True
+    def summary(self):
+        return "QuickXplain made {} consistency checks in {:.4f} seconds{}".format(
+            self.nChecks, self.runtime, "" if self.complete else " (check budget reached)")
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
-                var.unassign()
+    def print_stats(self):
+        print(self.summary())
+
+    def explain(self, groups, max_checks=None, node_limit=None, time_limit=None):
+        '''groups is a dictionary mapping a name to a list of
+           constraints of the CSP. Return the list of names of a minimal
+           set of groups with no solution, [] if the variables have no
+           solution even without constraints, or None if all the groups
+           together do have a solution (or if complete is False, could
+           not be shown to have none within the limits).'''
+        self.nChecks = 0
+        self.complete = True
+        self.max_checks = max_checks
+        self.node_limit = node_limit
+        self.time_limit = time_limit
+        stime = time.process_time()
+        names = list(groups)
+        self.groups = groups
+        if self.consistent(names):
+            conflict = None
+        elif self.complete and not self.consistent([]):
+            conflict = []
+        else:
+            conflict = self.qx([], False, names)
+        self.runtime = time.process_time() - stime
+        return conflict
+
+    def qx(self, background, delta, names):
+        '''Return a minimal subset of names that has no solution
+           together with background. delta is True if constraints were
+           just added to the background, so it may have no solution on
+           its own.'''
+        if delta and not self.consistent(background):
+            return []
+        if len(names) == 1:
+            return list(names)
+        k = len(names) // 2
+        names1 = names[:k]
+        names2 = names[k:]
+        conflict2 = self.qx(background + names1, True, names2)
+        conflict1 = self.qx(background + conflict2, len(conflict2) > 0, names1)
+        return conflict1 + conflict2
+
+    def consistent(self, names):
+        '''Search for a solution of the CSP restricted to the named
+           groups. Past the check limit, or if the search runs out of
+           budget, just assume there is one.'''
+        if self.max_checks is not None and self.nChecks >= self.max_checks:
+            self.complete = False
+            return True
+        self.nChecks = self.nChecks + 1
+        sub = CSP(self.csp.name, self.csp.vars)
+        for name in names:
+            for c in self.groups[name]:
+                sub.add_constraint(c)
+        solver = BT(sub)
+        status = solver.solve(self.propagator, node_limit=self.node_limit,
+                              time_limit=self.time_limit).status
+        solver.restore_all_variable_domains()
+        if status == UNKNOWN:
+            self.complete = False
+        return status != UNSAT
 
-            self.restoreUnasgnVar(var)
-            return False
+########################################################
+# Portfolio of searches in parallel                    #
+########################################################
 
+#the CSP built by a worker process, and the token to stop its searches
+_worker_csp = None
+_worker_cancel = None
+
+def _worker_init(build, args, event):
+    global _worker_csp, _worker_cancel
+    _worker_csp = build(*args)
+    _worker_cancel = CancelToken(event)
+
+def _portfolio_run(job):
+    '''Run one configuration of the portfolio on the worker's CSP. The
+       solution is sent back as the index of each variable's value in
+       its domain, so that no Variable objects need to be pickled.
+       deadline is the time.monotonic() time the whole race ends at.'''
+    k, config, node_limit, deadline = job
+    propagator, value_order, seed = config
+    csp = _worker_csp
+    if _worker_cancel.is_cancelled():
+        return k, UNKNOWN, None, 'cancelled', (0, 0, 0, 0)
+    time_limit = None
+    if deadline is not None:
+        time_limit = deadline - time.monotonic()
+        if time_limit <= 0:
+            return k, UNKNOWN, None, 'time', (0, 0, 0, 0)
+    try:
+        result = BT(csp, value_order=value_order, seed=seed).solve(
+            propagator, node_limit=node_limit, time_limit=time_limit,
+            cancel=_worker_cancel)
+    except Exception as e:
+        return k, UNKNOWN, None, 'error: {}'.format(e), (0, 0, 0, 0)
+    values = None
+    if result.status == SAT:
+        values = [v.value_index(result.assignment[v]) for v in csp.vars]
+    return (k, result.status, values, result.reason,
+            (result.nDecisions, result.nPrunings, result.nFails, result.runtime))
+
+def portfolio_solve(csp, build, args, configs, processes=None, 
+                    node_limit=None, time_limit=None):
+    '''Race several configurations of BT on the same CSP in a pool of
+       worker processes and return the first definitive (SAT or UNSAT)
+       SearchResult; the other searches are then cancelled (they stop
+       at their next variable assignment, see CancelToken).
+
+       csp is the CSP, as built by build(*args). Each worker process 
+       calls build(*args) to get its own copy, so build must always 
+       build the same CSP and be picklable (a module level function 
+       with picklable args). Each configuration is a tuple (propagator,
+       value_order, seed), see BT. The result's assignment is over the
+       variables of csp, and result.config is the configuration that
+       answered. If no configuration answers within the limits the 
+       result is UNKNOWN, with the reason the first one stopped, and 
+       result.config is None. 
+       node_limit is for each search, but time_limit is for the whole
+       race: configurations waiting for a free process only get the
+       time left.'''
+    configs = list(configs)
+    if processes is None:
+        processes = min(len(configs), multiprocessing.cpu_count())
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    jobs = [(k, config, node_limit, deadline) for k, config in enumerate(configs)]
+
+    answer = None
+    event = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes, _worker_init, (build, args, event))
+    try:
+        replies = pool.imap_unordered(_portfolio_run, jobs)
+        for _ in jobs:
+            try:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                k, status, values, reason, stats = replies.next(timeout)
+            except multiprocessing.TimeoutError:
+                if answer is None:
+                    answer = (None, UNKNOWN, None, 'time', (0, 0, 0, 0))
+                break
+            if status != UNKNOWN or answer is None:
+                answer = (k, status, values, reason, stats)
+            if status != UNKNOWN:
+                break
+    finally:
+        #Pool.terminate can deadlock if a worker is killed while it 
+        #holds the task queue's lock, so let the searches stop instead
+        event.set()
+        pool.close()
+        pool.join()
+
+    k, status, values, reason, stats = answer
+    assignment = None
+    if status == SAT:
+        assignment = dict(csp.fixed)
+        for v, i in zip(csp.vars, values):
+            assignment[v] = v.dom[i]
+    result = SearchResult(status, assignment, reason)
+    result.nDecisions, result.nPrunings, result.nFails, result.runtime = stats
+    if status != UNKNOWN:
+        result.config = configs[k]
+    return result
+
+def _split_subproblem(csp, part):
+    '''Helper for BT.solve_parallel. A subproblem is a list of 
+       (variable index, value index) pairs fixing some variables of csp.
+       Split it on the variable not yet fixed with the smallest domain
+       (most constraints on ties): return one subproblem per value, or
+       None if every variable is fixed.'''
+    fixed = set(i for i, j in part)
+    best = None
+    for i, v in enumerate(csp.vars):
+        if i in fixed or v.domain_size() < 2:
+            continue
+        key = (v.domain_size(), -len(csp.vars_to_cons[v]))
+        if best is None or key < best[0]:
+            best = (key, i)
+    if best is None:
+        return None
+    i = best[1]
+    return [part + [(i, j)] for j in range(csp.vars[i].domain_size())]
+
+def _subproblem_run(job):
+    '''Search one subproblem of BT.solve_parallel on the worker's CSP.
+       Returns the status, the solution as value indices (as for 
+       _portfolio_run), why the search stopped, its statistics, and the
+       parts of the subproblem, each with its node budget, if it was 
+       split.'''
+    part, propagator, value_order, seed, split_nodes, time_limit = job
+    csp = _worker_csp
+    if _worker_cancel.is_cancelled():
+        return UNKNOWN, None, 'cancelled', (0, 0, 0, 0), None
+    assumptions = [(csp.vars[i], csp.vars[i].dom[j]) for i, j in part]
+    #the variables fixed by the subproblem are assigned first, so they 
+    #do not count against split_nodes; no limit if it cannot be split
+    splittable = _split_subproblem(csp, part) is not None
+    node_limit = split_nodes + len(part) if splittable else None
+    solver = BT(csp, value_order=value_order, seed=seed)
+    try:
+        result = solver.solve(propagator, node_limit=node_limit, time_limit=time_limit,
+                              cancel=_worker_cancel, assumptions=assumptions)
+    except Exception as e:
+        return UNKNOWN, None, 'error: {}'.format(e), (0, 0, 0, 0), None
+    values = None
+    if result.status == SAT:
+        values = [v.value_index(result.assignment[v]) for v in csp.vars]
+    more = None
+    if result.reason == 'nodes':
+        #hand back what is left of the search tree
+        index = dict((v, i) for i, v in enumerate(csp.vars))
+        fixed = set(i for i, j in part)
+        more = []
+        for subtree in solver.frontier:
+            extra = [(index[v], v.value_index(val)) for v, val in subtree if not index[v] in fixed]
+            more.append((part + extra, 2 * split_nodes))
+    return (result.status, values, result.reason, 
+            (result.nDecisions, result.nPrunings, result.nFails, result.runtime), more)
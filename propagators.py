@@ -34,6 +34,13 @@
       NOTE propagator SHOULD NOT prune a value that has already been 
       pruned! Nor should it prune a value twice
 
+      During bt_search csp.trail is set to the search Trail. The
+      propagators below then push their prunings directly onto it 
+      (see record_pruning) and return an empty list, so no lists of
+      prunings are built or concatenated. When returning False they set
+      csp.last_conflict to the constraint that failed, which bt_search 
+      uses to weight constraints for the dom/wdeg heuristic.
+
       PROPAGATOR called with newly_instantiated_variable = None
       PROCESSING REQUIRED:
         for plain backtracking (where we only check fully instantiated constraints)
@@ -59,19 +66,31 @@
          
    '''
 
+from cspbase import PropagationQueue
+
+def record_pruning(trail, pruned, var, val):
+    '''Prune val from var and record it: on the trail if there is one,
+       otherwise in the list pruned. '''
+    var.prune_value(val)
+    if trail is None:
+        pruned.append((var, val))
+    else:
+        trail.push(var, val)
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no 
     propagation at all. Just check fully instantiated constraints'''
     
     if not newVar:
         return True, []
-    for c in csp.get_cons_with_var(newVar):
-        if c.get_n_unasgn() == 0:
+    for c in csp.vars_to_cons[newVar]:
+        if c.n_unasgn == 0:
             vals = []
             vars = c.get_scope()
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                csp.last_conflict = c
                 return False, []
     return True, []
 
@@ -85,40 +104,43 @@ def prop_FC(csp, newVar=None):
         for c in csp.get_all_cons():
             if len(c.get_scope()) == 1:
                 v = c.get_scope()[0]
-                r, l = fccheck(c, v)
+                r, l = fccheck(c, v, csp.trail)
                 pruned += l
                 if not r:
+                    csp.last_conflict = c
                     return False, pruned
                 
         for c in csp.get_all_cons():
-            if c.get_n_unasgn() == 1:
+            if c.n_unasgn == 1:
                 v = c.get_unasgn_vars()[0]
-                r, l = fccheck(c, v)
+                r, l = fccheck(c, v, csp.trail)
                 pruned += l
                 if not r:
+                    csp.last_conflict = c
                     return False, pruned    
     else:
-        for c in csp.get_all_cons():
-            if c.get_n_unasgn() == 1 and newVar in c.get_scope():
+        for c in csp.vars_to_cons[newVar]:
+            if c.n_unasgn == 1:
                 v = c.get_unasgn_vars()[0]
-                r, l = fccheck(c, v)
+                r, l = fccheck(c, v, csp.trail)
                 pruned += l
                 if not r:
+                    csp.last_conflict = c
                     return False, pruned
                 
     return True, pruned
 
-def fccheck(c, v):
-    '''Perform a forward check with Constraint c and Variable v. '''
+def fccheck(c, v, trail=None):
+    '''Perform a forward check with Constraint c and Variable v. Prunings are
+    pushed on trail if given, otherwise returned. '''
     pruned = []
     for val in v.cur_domain():
         v.assign(val)
         test = get_vals(c)
-        if not c.check(test):
-            v.prune_value(val)
-            pruned.append((v, val))
         v.unassign()
-    if len(v.cur_domain()) == 0:
+        if not c.check(test):
+            record_pruning(trail, pruned, v, val)
+    if v.cur_domain_size() == 0:
         return False, pruned
     else:
         return True, pruned
@@ -137,35 +159,61 @@ def prop_GAC(csp, newVar=None):
        processing all constraints. Otherwise we do GAC enforce with
        constraints containing newVar on GAC Queue'''
     #IMPLEMENT
+    q = get_queue(csp)
     if not newVar:
-        q = csp.get_all_cons().copy()
-        r, l = enforce_GAC(q, csp)
+        q.extend(csp.get_all_cons())
     else:
-        q = csp.get_all_cons().copy()
-        for c in csp.get_all_cons():
-            if newVar not in c.get_scope():
-                q.remove(c)
-        r, l = enforce_GAC(q, csp)
+        q.extend(csp.vars_to_cons[newVar])
+    return enforce_GAC(q, csp)
         
-    if not r:
-        return False, l
+def prop_GAC2001(csp, newVar=None):
+    '''Same as prop_GAC but table constraints look for supports with the GAC-2001
+       scheme (see Constraint.has_support_2001) instead of residues. '''
+    q = get_queue(csp)
+    if not newVar:
+        q.extend(csp.get_all_cons())
     else:
-        return True, l
+        q.extend(csp.vars_to_cons[newVar])
+    return enforce_GAC(q, csp, True)
+
+def get_queue(csp):
+    '''Return an empty PropagationQueue, the one bt_search set up if there is one. '''
+    if csp.queue is None:
+        return PropagationQueue()
+    csp.queue.clear()
+    return csp.queue
         
-def enforce_GAC(q, csp):
-    '''Enforce GAC with the variables in csp and using the constraints in list
-    q. '''
+def enforce_GAC(q, csp, gac2001=False):
+    '''Enforce GAC with the variables in csp and using the constraints in q (a
+    PropagationQueue or a list). If gac2001 is True supports are found with 
+    has_support_2001. 
+    
+    A constraint is revised until none of its variables lose a value, so it
+    need not be queued again because of its own prunings. Losing the value of
+    an assigned variable is a dead end like a domain wipe out. '''
+    if not isinstance(q, PropagationQueue):
+        cons = q
+        q = PropagationQueue()
+        q.extend(cons)
     pruned = []
+    trail = csp.trail
     while len(q) > 0:
         c = q.pop()
-        for v in c.get_scope():
-            for val in v.cur_domain():
-                if not c.has_support(v, val):
-                    v.prune_value(val)
-                    pruned.append((v, val))
-                    if len(v.cur_domain()) == 0:
-                        return False, pruned
+        changed = True
+        while changed:
+            changed = False
+            for v in c.get_scope():
+                for val in v.cur_domain():
+                    if gac2001:
+                        ok = c.has_support_2001(v, val, trail)
                     else:
-                        q += csp.get_cons_with_var(v)
+                        ok = c.has_support(v, val)
+                    if not ok:
+                        record_pruning(trail, pruned, v, val)
+                        if v.is_assigned() or v.cur_domain_size() == 0:
+                            csp.last_conflict = c
+                            return False, pruned
+                        q.extend(csp.vars_to_cons[v], c)
+                        changed = True
                     
-    return True, pruned
\ No newline at end of file
+    return True, pruned
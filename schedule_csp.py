@@ -5,8 +5,10 @@
 
 from cspbase import *
 from propagators import *
-import itertools
 import copy
+import time
+import multiprocessing
+import multiprocessing.connection
 
 '''
 
@@ -98,9 +100,12 @@ def assign_resource(r, r_list):
     for i in r_list:
         if i.resource_name == r:
             return [i]
+    return []
 
-def csp_setup(name, app, res, staff):
-    '''Create CSP object and all Variable objects needed along with their domains. '''
+def csp_setup(name, app, res, staff, by_position=True):
+    '''Create CSP object and all Variable objects needed along with their domains. 
+    If by_position is False every staff member is in the domain of every staff variable,
+    and add_correct_staff_constraints must be used. '''
     
     csp = CSP(name)
     app_vars = copy.deepcopy(app) # this will be used for printing final solution
@@ -126,7 +131,10 @@ def csp_setup(name, app, res, staff):
         s_list = []
         v = Variable('staff'+str(staff_count))
         csp.add_var(v)
-        v.add_domain_values(staff)
+        if by_position:
+            v.add_domain_values([p for p in staff if p.pos in app[a].position]) # only staff with a correct position
+        else:
+            v.add_domain_values(staff)
         staff_vars.append(v)
         app_vars[a].position = v
         
@@ -137,9 +145,7 @@ def add_overlapping_staff_constraints(csp, overlaps, staff_list):
     for i in overlaps:
         if len(i) > 1:  # overlaps found
             c_vars = [j.position for j in i]
-            c = Constraint('overlap_staff', c_vars)
-            sat = list(itertools.permutations(staff_list, len(i)))
-            c.add_satisfying_tuples(sat)
+            c = AllDifferentConstraint('overlap_staff', c_vars)
             csp.add_constraint(c)
             
 def add_correct_staff_constraints(csp, app_list, app_vars, staff_list):
@@ -147,54 +153,62 @@ def add_correct_staff_constraints(csp, app_list, app_vars, staff_list):
     for i in range(len(app_list)):
         p = app_list[i].position
         v = app_vars[i].position
-        s = []
-        for j in staff_list:
-            if j.pos in p:
-                s.append((j,))
-        c = Constraint('correct_staff_position', [v])
-        c.add_satisfying_tuples(s)  
+        c = CompactTableConstraint('correct_staff_position', [v])
+        c.add_satisfying_tuples(filtered_product([staff_list], has_position(p)))  
         csp.add_constraint(c)
         
+def has_position(positions):
+    '''Helper for add_correct_staff_constraints. Return a predicate accepting a
+    tuple whose staff members all hold one of positions. '''
+    def check(t):
+        for j in t:
+            if not j.pos in positions:
+                return False
+        return True
+    return check
+        
         
 def add_maxh_staff_constraints(csp, app_list, staff_vars, staff_list):
-    '''Each staff member should work at least their established maximum
+    '''Each staff member should work at most their established maximum
     number of appointments. '''
     
-    args = [staff_list for m in range(len(app_list))]
-    tuples = list(itertools.product(*args))
-    
+    bounds = dict()
     for i in staff_list:
-        for j in range(len(tuples)):
-            if tuples[j] != None and tuples[j].count(i) > i.maxh:
-                tuples[j] = None
-                
-    while None in tuples:
-        tuples.remove(None)   
+        bounds[i] = (0, i.maxh)
         
-    c = Constraint('maxh', staff_vars)
-    c.add_satisfying_tuples(tuples)  
+    c = CardinalityConstraint('maxh', staff_vars, bounds)
     csp.add_constraint(c)
     
 def add_minh_staff_constraints(csp, app_list, staff_vars, staff_list):
     '''Each staff member should work at least their established minimum
     number of appointments. '''
     
-    args = [staff_list for m in range(len(app_list))]
-    tuples = list(itertools.product(*args))
-    
+    bounds = dict()
     for i in staff_list:
-        for j in range(len(tuples)):
-            if tuples[j] != None and tuples[j].count(i) < i.minh:
-                tuples[j] = None
-                
-    while None in tuples:
-        tuples.remove(None)   
+        bounds[i] = (i.minh, len(app_list))
         
-    c = Constraint('minh', staff_vars)
-    c.add_satisfying_tuples(tuples)  
+    c = CardinalityConstraint('minh', staff_vars, bounds)
     csp.add_constraint(c)
         
         
+def available_staff(staff_list):
+    '''Helper for schedule_model. Staff who cannot work any appointment are left out. '''
+    return [i for i in staff_list if i.maxh > 0]
+
+def staff_hours_infeasible(app_list, staff_list):
+    '''Return True if the staff hours alone show there is no solution: someone's minimum
+    is above their maximum, the minimums add up to more than the number of appointments,
+    or the maximums add up to less. One pass over the staff. '''
+    n = len(app_list)
+    total_min = 0
+    total_max = 0
+    for i in staff_list:
+        if i.minh > i.maxh:
+            return True
+        total_min += i.minh
+        total_max += min(i.maxh, n)
+    return total_min > n or total_max < n
+
 def get_reusable_resources(r):
     '''Helper for add_reusable_resource_constraints. '''
     result = []
@@ -203,26 +217,21 @@ def get_reusable_resources(r):
             result.append(i)
     return result
 
-def add_reusable_resource_constraints(csp, overlap_vars, resource_list):
+def add_reusable_resource_constraints(csp, app_vars, resource_list):
     '''Overlapping appointments do not use more of one type of reusable resource 
-    than what is available'''
+    than what is available. One constraint per reusable resource over the uses of
+    that resource and the times the appointments using it take place. '''
     
-    for i in overlap_vars:
-        if len(i) > 1:
-            reusables = get_reusable_resources(resource_list)
-            resources = [r for l in i for r in l.resources]
-            args = [resource_list for m in range(len(resources))]
-            tuples = list(itertools.product(*args))
-
-            for j in reusables:
-                for k in range(len(tuples)):
-                    if tuples[k] != None and tuples[k].count(j) > j.qty_total:
-                        tuples[k] = None
-            while None in tuples:
-                tuples.remove(None)
-
-            c = Constraint('reusable_resources', resources)
-            c.add_satisfying_tuples(tuples)  
+    for j in get_reusable_resources(resource_list):
+        resources = []
+        intervals = []
+        for i in app_vars:
+            for r in i.resources:
+                if j in r.domain():
+                    resources.append(r)
+                    intervals.append((i.start_time, i.end_time))
+        if len(resources) > j.qty_total:
+            c = CumulativeConstraint('reusable_resources', resources, intervals, {j: j.qty_total})
             csp.add_constraint(c)
       
 def get_nonreusable_resources(r):
@@ -250,73 +259,406 @@ def add_nonreusable_resource_constraints(csp, app_list, app_vars, resource_list)
         for j in range(len(app_list[i].resources)):
             if is_nonreuseable(app_list[i].resources[j], nonreusables):
                 resources.append(app_vars[i].resources[j])
-                
-    args = [resource_list for m in range(len(resources))]
-    tuples = list(itertools.product(*args)) 
     
+    capacities = dict()
     for j in nonreusables:
-        for k in range(len(tuples)):
-            if tuples[k] != None and tuples[k].count(j) > j.qty_total:
-                tuples[k] = None
-    while None in tuples:
-        tuples.remove(None)    
+        capacities[j] = j.qty_total
     
-    c = Constraint('nonreusable_resources', resources)
-    c.add_satisfying_tuples(tuples)  
+    c = CapacityConstraint('nonreusable_resources', resources, capacities)
     csp.add_constraint(c)    
 
 def get_overlapping_appointments(app_vars):
-    '''Return a nested list of overlapping appointments. '''
+    '''Return a nested list of overlapping appointments: each group is a maximal set of
+    appointments all taking place at the same time, and only groups of more than one
+    appointment are returned. Start and end times can be any numbers (e.g., minutes
+    or hours over several days); an appointment ending at t does not overlap one
+    starting at t.
     
-    day = [[] for i in range(0,24)] # create a list of 24 empty lists, each representing an hour of the day
-
-    for av in app_vars:
-        for x in range(av.start_time, av.end_time):
-            day[x].append(av)
+    Sweep over the sorted start/end times keeping the set of appointments in progress.
+    That set is a maximal group whenever an appointment is about to end right after
+    one has started, so every group is found exactly once. '''
+    
+    events = []
+    for i in range(len(app_vars)):
+        av = app_vars[i]
+        if av.start_time < av.end_time:
+            events.append((av.start_time, 1, i))
+            events.append((av.end_time, 0, i))     # ends sort before starts at equal times
+    events.sort()
 
-    overlaps = [s for s in day if len(s)>1]
+    overlaps = []
+    active = dict()
+    started = False
+    for t, is_start, i in events:
+        if is_start:
+            active[i] = app_vars[i]
+            started = True
+        else:
+            if started and len(active) > 1:
+                overlaps.append(list(active.values()))
+            started = False
+            del active[i]
 
     return overlaps
 
+# names of the families of constraints explain_schedule reports
+CONSTRAINT_FAMILIES = {'correct_staff_position': 'staff position',
+                       'overlap_staff': 'overlapping appointments',
+                       'maxh': 'staff maximum hours',
+                       'minh': 'staff minimum hours',
+                       'reusable_resources': 'reusable resources',
+                       'nonreusable_resources': 'non-reusable resources'}
+
+def explain_schedule(a,r,s,max_checks=32,check_nodes=10000,check_time=None,reporter=None):
+    '''Explain why there is no schedule. Return a minimal list of constraint families
+    (see CONSTRAINT_FAMILIES) that together rule out every schedule, i.e. relaxing any
+    one of them (e.g. more staff hours) could make the problem solvable; [] if some
+    appointment needs a resource that is not in the resource list or there is no staff
+    at all; None if there is a schedule. At most max_checks searches are made, each 
+    stopped after check_nodes variable assignments and check_time seconds (if given), see
+    QuickXplain. Presolving is not done here so that every family can be blamed. 
+    The number of searches is only printed if a reporter is given. '''
+    csp, app_vars, res_vars, staff_vars = csp_setup('explain',a,r,s,by_position=False)
+    var_overlaps = get_overlapping_appointments(app_vars)
+    add_overlapping_staff_constraints(csp, var_overlaps, s)
+    add_correct_staff_constraints(csp, a, app_vars, s)
+    add_maxh_staff_constraints(csp, a, staff_vars, s)
+    add_minh_staff_constraints(csp, a, staff_vars, s)
+    add_reusable_resource_constraints(csp, app_vars, r)
+    add_nonreusable_resource_constraints(csp, a, app_vars, r)
+    
+    groups = dict()
+    for c in csp.get_all_cons():
+        groups.setdefault(CONSTRAINT_FAMILIES[c.name], []).append(c)
+    explainer = QuickXplain(csp, prop_GAC)
+    conflict = explainer.explain(groups, max_checks, check_nodes, check_time)
+    if reporter is not None:
+        reporter.message(explainer.summary())
+    return conflict
+
+def format_soln(a, staff):
+    '''Return the final arrangement of staff to appointments as text, given the staff member
+    of each appointment. Note that resources are not listed because as long as the CSP is 
+    solvable, all resource constraints are met. '''
+    result = ["--- Final Schedule ---\n"]
+    for n, i in enumerate(a):
+        result.append('Appointment' + str(n) + ' at ' + str(i.start_time) + '-' + str(i.end_time) + ':\n')
+        result.append('\tStaff: '+ str(staff[n].name) + ', ' + str(staff[n].pos) + '\n')
+    return "".join(result)
+
 def print_soln(l):
-    '''Print the final arrangement of staff to appointments. Note that resources are not listed
-    because as long as the CSP is solvable, all resource constraints are met. '''
-    result = ""
-    result += "--- Final Schedule ---\n"
-    for i in l:
-        result += ('Appointment' + str(l.index(i)) + ' at ' + str(i.start_time) + '-' + str(i.end_time) + ':\n')
-        result += ('\tStaff: '+ str(i.position.get_assigned_value().name) + ', ' + str(i.position.get_assigned_value().pos) + '\n')
-    print(result)
+    '''Print the final arrangement of staff to appointments (l is the list of appointments of
+    a solved schedule_model). '''
+    print(format_soln(l, [i.position.get_assigned_value() for i in l]))
         
 def schedule_model(a,r,s):
     '''Create the CSP, all the Variable objects and all the Constraints. Return the final CSP
     and all the appointments to print the final output if the problem has a solution. '''
-    # setup 
-    csp, app_vars, res_vars, staff_vars = csp_setup('schedule',a,r,s)
+    # setup; staff domains only hold staff with a correct position (so no constraints
+    # are needed for that) and who can work at least one appointment
+    staff = available_staff(s)
+    csp, app_vars, res_vars, staff_vars = csp_setup('schedule',a,r,staff)
+    
+    # presolve: reject inputs that cheap counting shows are infeasible before
+    # building any constraints
+    if staff_hours_infeasible(a, s) or any(v.domain_size() == 0 for v in csp.get_all_vars()):
+        csp.infeasible = True
+        return csp, app_vars
     
     # overlapping appointments
     var_overlaps = get_overlapping_appointments(app_vars)
     
     # constraints
-    add_overlapping_staff_constraints(csp, var_overlaps, s)
-    add_correct_staff_constraints(csp, a, app_vars, s)
-    add_maxh_staff_constraints(csp, a, staff_vars, s)
-    add_minh_staff_constraints(csp, a, staff_vars, s)
-    add_reusable_resource_constraints(csp, var_overlaps, r)
+    add_overlapping_staff_constraints(csp, var_overlaps, staff)
+    add_maxh_staff_constraints(csp, a, staff_vars, staff)
+    add_minh_staff_constraints(csp, a, staff_vars, staff)
+    add_reusable_resource_constraints(csp, app_vars, r)
     add_nonreusable_resource_constraints(csp, a, app_vars, r)
     
+    # presolve: every resource variable has a single value, so fold them into the
+    # constraints as constants instead of searching over them, then drop the
+    # constraints that can no longer be violated
+    csp.eliminate_fixed_vars()
+    csp.drop_entailed_constraints()
+    
     return csp, app_vars
         
-def solve_schedule(a,r,s):
-    '''Solve the CSP for this problem. '''
+def find_schedule(a,r,s,time_limit=None,reporter=None):
+    '''Search for a schedule without printing anything (unless a reporter is given, see
+    ConsoleReporter). Return the SearchResult of the search and the list of the staff members
+    assigned to the appointments, in the order of a (None if no schedule was found). '''
+    csp, app_vars = schedule_model(a,r,s)
+    result = BT(csp, reporter).solve(prop_GAC, time_limit=time_limit)
+    if result.status != SAT:
+        return result, None
+    return result, [result.assignment[i.position] for i in app_vars]
+        
+def build_schedule_csp(a,r,s):
+    '''Helper for find_schedule_portfolio: the CSP of schedule_model on its own. '''
+    return schedule_model(a,r,s)[0]
+
+# configurations (propagator, value order, seed) find_schedule_portfolio races by default
+PORTFOLIO = [(prop_GAC, 'domain', None),
+             (prop_GAC2001, 'domain', None),
+             (prop_GAC, 'reverse', None),
+             (prop_GAC, 'random', 1),
+             (prop_GAC, 'random', 2),
+             (prop_FC, 'domain', None)]
+
+def find_schedule_portfolio(a,r,s,configs=PORTFOLIO,processes=None,time_limit=None):
+    '''Same as find_schedule, but race several search configurations (see PORTFOLIO) in a
+    pool of worker processes and use the first one to find a schedule or show there is none
+    (see portfolio_solve). '''
+    csp, app_vars = schedule_model(a,r,s)
+    result = portfolio_solve(csp, build_schedule_csp, (a,r,s), configs, processes, 
+                             time_limit=time_limit)
+    if result.status != SAT:
+        return result, None
+    return result, [result.assignment[i.position] for i in app_vars]
+
+def find_schedules(a,r,s,limit=None,time_limit=None):
+    '''Generator of the schedules of the problem, each a list of the staff members assigned to
+    the appointments as for find_schedule, yielded as soon as the search finds them (see 
+    BT.solutions). Stops after limit schedules or time_limit seconds, if given. '''
+    csp, app_vars = schedule_model(a,r,s)
+    for assignment in BT(csp).solutions(prop_GAC, limit, time_limit=time_limit):
+        yield [assignment[i.position] for i in app_vars]
+
+def count_schedules(a,r,s,limit=None,time_limit=None):
+    '''Count the schedules of the problem without building them. Returns the SearchResult of
+    BT.count_solutions: the count is its nSolutions, and its status is UNKNOWN if there are
+    more than limit schedules or time_limit ran out. '''
+    csp, app_vars = schedule_model(a,r,s)
+    return BT(csp).count_solutions(prop_GAC, limit, time_limit=time_limit)
+
+def staff_scope(csp, app_vars):
+    '''Helper for the objectives: return the staff variables searched over, and a dictionary
+    (index in a -> staff member) of the appointments whose staff presolving already fixed. '''
+    scope = []
+    fixed = dict()
+    for n, i in enumerate(app_vars):
+        if i.position in csp.fixed:
+            fixed[n] = csp.fixed[i.position]
+        else:
+            scope.append(i.position)
+    return scope, fixed
+
+def load_imbalance(csp, app_vars, s):
+    '''Objective for find_best_schedule: the difference between the most and the fewest
+    appointments given to a staff member. '''
+    scope, fixed = staff_scope(csp, app_vars)
+    initial = dict()
+    for staff in fixed.values():
+        initial[staff] = initial.get(staff, 0) + 1
+    return LoadImbalanceObjective('load imbalance', scope, available_staff(s), initial)
+
+def overtime(csp, app_vars, s):
+    '''Objective for find_best_schedule: the total number of appointments given to staff
+    members beyond their minimum. '''
+    scope, fixed = staff_scope(csp, app_vars)
+    initial = dict()
+    for staff in fixed.values():
+        initial[staff] = initial.get(staff, 0) + 1
+    regular = dict((i, i.minh) for i in available_staff(s))
+    return OvertimeObjective('overtime', scope, regular, initial)
+
+def preferences(penalty):
+    '''Return an objective for find_best_schedule: the sum of penalty(n, staff) over the
+    appointments, where penalty(n, staff) is the cost of giving appointment a[n] to the staff
+    member (e.g., 1 if they would rather not work it, 0 otherwise). '''
+    def objective(csp, app_vars, s):
+        scope, fixed = staff_scope(csp, app_vars)
+        index = dict((i.position, n) for n, i in enumerate(app_vars))
+        offset = sum(penalty(n, staff) for n, staff in fixed.items())
+        return PenaltyObjective('preferences', scope, lambda var, val: penalty(index[var], val),
+                                offset)
+    return objective
+
+def find_best_schedule(a,r,s,objective=load_imbalance,time_limit=None,reporter=None):
+    '''Search for the schedule minimizing objective, a function (csp, app_vars, s) returning
+    an ObjectiveConstraint over the model of schedule_model (see load_imbalance, overtime and
+    preferences), by branch and bound (see BT.minimize). Return the SearchResult, with the
+    value of the schedule in its objective, and the staff list as for find_schedule. If 
+    time_limit runs out, the best schedule found so far is returned (the result's reason is
+    then 'time'). '''
+    csp, app_vars = schedule_model(a,r,s)
+    result = BT(csp, reporter).minimize(prop_GAC, objective(csp, app_vars, s), 
+                                        time_limit=time_limit)
+    if result.assignment is None:
+        return result, None
+    return result, [result.assignment[i.position] for i in app_vars]
+
+def find_schedule_parallel(a,r,s,processes=None,time_limit=None):
+    '''Same as find_schedule, but split the search between a pool of worker processes (see
+    BT.solve_parallel). Worth it when there is no schedule, as the whole search tree must then 
+    be explored. '''
+    csp, app_vars = schedule_model(a,r,s)
+    result = BT(csp).solve_parallel(prop_GAC, build_schedule_csp, (a,r,s), processes, 
+                                    time_limit=time_limit)
+    if result.status != SAT:
+        return result, None
+    return result, [result.assignment[i.position] for i in app_vars]
+        
+def _solve_one(job):
+    '''Helper for solve_many, run in a worker process: build and solve one problem. The
+    schedule is sent back as the index in s of each appointment's staff member. Errors are
+    caught so one bad problem does not stop the others. '''
+    k, (a,r,s), time_limit = job
+    start = time.monotonic()
     try:
         csp, app_vars = schedule_model(a,r,s)
-        solver = BT(csp)
-        print("=======================================================")
-        print("using GAC")
-        solver.bt_search(prop_GAC)
-        print_soln(app_vars)  
+        if time_limit is not None:
+            time_limit = max(0, time_limit - (time.monotonic() - start))
+        result = BT(csp).solve(prop_GAC, time_limit=time_limit)
+    except Exception as e:
+        return k, UNKNOWN, None, 'error: {}'.format(e), (0, 0, 0, 0)
+    staff = None
+    if result.status == SAT:
+        index = dict((id(p), i) for i, p in enumerate(s))
+        staff = [index[id(result.assignment[i.position])] for i in app_vars]
+    return (k, result.status, staff, result.reason, 
+            (result.nDecisions, result.nPrunings, result.nFails, result.runtime))
+
+def _solve_worker(conn):
+    '''Helper for solve_many: a worker process solving the jobs received on conn (see
+    _solve_one) until it receives None. '''
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        conn.send(_solve_one(job))
+
+def _start_worker():
+    '''Helper for solve_many: start a worker process. Return [process, connection, job],
+    job being None while the worker is idle. '''
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_solve_worker, args=(child,), daemon=True)
+    process.start()
+    child.close()
+    return [process, conn, None]
+
+def _stop_worker(worker):
+    '''Helper for solve_many: stop a worker process, killing it if it is busy. '''
+    process, conn, job = worker
+    if job is None and process.is_alive():
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+    else:
+        process.kill()
+    process.join()
+    conn.close()
+
+# seconds a worker is given past time_limit to report before solve_many kills it
+SOLVE_MANY_GRACE = 1.0
+
+def solve_many(problems, processes=None, time_limit=None):
+    '''Solve many independent problems, each a triple (a,r,s) of lists of appointments,
+    resources and staff, in a pool of processes (by default one per CPU). This is a generator:
+    it yields (k, result, staff) for the k-th problem as soon as it is solved, so results come
+    in completion order; result is the SearchResult and staff as for find_schedule. Problems
+    are taken from problems only as processes become free, so it can be a generator too.
+    
+    Each problem (building its model and searching) gets time_limit seconds, if given; then
+    its status is UNKNOWN with reason 'time'. A process still busy SOLVE_MANY_GRACE seconds
+    later (e.g., stuck building the model) is killed and replaced. A problem that raises an
+    error, or whose process dies, is also UNKNOWN, with the error as its reason, and the other
+    problems are not affected. Nothing is printed. '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    problems = enumerate(problems)
+    workers = []
+    more = True
+    try:
+        while True:
+            # give each idle process a problem, starting processes as needed
+            while more:
+                idle = [w for w in workers if w[2] is None]
+                if not idle and len(workers) < processes:
+                    idle = [_start_worker()]
+                    workers.append(idle[0])
+                if not idle:
+                    break
+                job = next(problems, None)
+                if job is None:
+                    more = False
+                    break
+                k, problem = job
+                deadline = None
+                if time_limit is not None:
+                    deadline = time.monotonic() + time_limit + SOLVE_MANY_GRACE
+                idle[0][1].send((k, problem, time_limit))
+                idle[0][2] = (k, problem, deadline)
+            busy = [w for w in workers if w[2] is not None]
+            if not busy:
+                break
+            
+            timeout = None
+            deadlines = [w[2][2] for w in busy if w[2][2] is not None]
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.monotonic())
+            ready = multiprocessing.connection.wait([w[1] for w in busy] + 
+                                                    [w[0].sentinel for w in busy], timeout)
+            for w in busy:
+                process, conn, (k, (a,r,s), deadline) = w
+                reply = None
+                if conn in ready:
+                    try:
+                        reply = conn.recv()
+                    except EOFError:
+                        pass
+                if reply is None:
+                    if process.sentinel in ready or conn in ready:
+                        reason = 'error: worker process exited'
+                    elif deadline is not None and time.monotonic() >= deadline:
+                        reason = 'time'
+                    else:
+                        continue
+                    _stop_worker(w)
+                    workers.remove(w)
+                    reply = (k, UNKNOWN, None, reason, (0, 0, 0, 0))
+                w[2] = None
+                k, status, staff, reason, stats = reply
+                result = SearchResult(status, reason=reason)
+                result.nDecisions, result.nPrunings, result.nFails, result.runtime = stats
+                if staff is not None:
+                    staff = [s[i] for i in staff]
+                yield k, result, staff
+    finally:
+        for w in workers:
+            _stop_worker(w)
+        
+def solve_schedule(a,r,s,explain=False,time_limit=None,reporter=None):
+    '''Solve the CSP for this problem. Return True if there is a schedule, False if there is
+    none and None if time_limit (seconds) is given and the search takes longer. If there is no
+    solution and explain is True, also print which families of constraints conflict (see 
+    explain_schedule, to get them as a list instead). Nothing is printed unless a reporter is
+    given: e.g., with ConsoleReporter() the schedule or the reason there is none is printed,
+    so explain needs one. '''
+    if explain and reporter is None:
+        raise ValueError('explain=True needs a reporter to print the explanation; '
+                         'use explain_schedule to get it as a list')
+    if reporter is not None:
+        reporter.message("=======================================================")
+        reporter.message("using GAC")
+    result, staff = find_schedule(a,r,s,time_limit,reporter)
+    if staff is not None:
+        if reporter is not None:
+            reporter.message(format_soln(a, staff))
         return True
-    except AttributeError:
-        print('No Solution; insufficient resources and/or unviable staff hours')    
-        return False
\ No newline at end of file
+    if result.status == UNKNOWN:
+        if reporter is not None:
+            reporter.message('No Solution found within the time limit')
+        return None
+    if reporter is None:
+        return False
+    if explain:
+        conflict = explain_schedule(a,r,s,reporter=reporter)
+        if conflict:
+            reporter.message('No Solution; conflicting constraints: ' + ', '.join(conflict))
+        else:
+            reporter.message('No Solution; an appointment needs a resource that is not listed, or there is no staff')
+    else:
+        reporter.message('No Solution; insufficient resources and/or unviable staff hours')    
+    return False
\ No newline at end of file
@@ -4,6 +4,11 @@
 #Sandy Tran		996419148	g3transa
 
 from schedule_csp import *
+import threading
+import random
+import itertools
+import os
+import time
 
 def case1():
     # --- General case; has solution ----
@@ -333,6 +338,305 @@ def case8b():
     
     return solve_schedule(a,r,s)
     
+def case9a():
+    # --- no solution; not enough staff for parallel appointments ----
+    #appointments
+    a = [Appointment(1, 3, ['needle'], ['nurse']) for i in range(10)]
+    
+    #resources
+    r1 = Resource('needle', 10, False)
+    r = [r1]
+    
+    #staff
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 2) for i in range(9)]
+    
+    return solve_schedule(a,r,s)
+
+def case9b():
+    # --- solution; enough staff for parallel appointments ----
+    #appointments
+    a = [Appointment(1, 3, ['needle'], ['nurse']) for i in range(10)]
+    
+    #resources
+    r1 = Resource('needle', 10, False)
+    r = [r1]
+    
+    #staff
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 2) for i in range(10)]
+    
+    return solve_schedule(a,r,s)
+    
+def case10():
+    # --- no solution; explanation blames the overlaps and the staff positions ----
+    #appointments
+    a1 = Appointment(1, 3, ['needle'], ['doctor'])
+    a2 = Appointment(2, 4, ['needle'], ['doctor'])
+    a3 = Appointment(5, 6, ['needle'], ['nurse', 'doctor'])
+    a = [a1,a2,a3]
+    
+    #resources
+    r1 = Resource('needle', 5, False)
+    r = [r1]
+    
+    #staff
+    s1 = Staff('Jean', 'nurse', 0, 3)
+    s2 = Staff('Diana', 'doctor', 0, 3)
+    s = [s1,s2]
+    
+    if explain_schedule(a,r,s) != ['overlapping appointments', 'staff position']:
+        return False
+    
+    # a hard check runs out of its node budget, so nothing is blamed for sure
+    csp = pigeonhole(12)
+    explainer = QuickXplain(csp, prop_FC)
+    groups = {'holes': csp.get_all_cons()}
+    return explainer.explain(groups, node_limit=1000) is None and not explainer.complete
+    
+def case11():
+    # --- best schedule shares the appointments evenly and respects a preference ----
+    #appointments
+    a = [Appointment(i, i + 1, ['needle'], ['nurse']) for i in range(4)]
+    
+    #resources
+    r1 = Resource('needle', 4, False)
+    r = [r1]
+    
+    #staff
+    s1 = Staff('Jean', 'nurse', 0, 4)
+    s2 = Staff('Rosa', 'nurse', 0, 4)
+    s = [s1,s2]
+    
+    result, staff = find_best_schedule(a,r,s)
+    if result.objective != 0 or staff.count(s1) != 2:
+        return False
+    # Jean would rather not work the first two appointments
+    result, staff = find_best_schedule(a,r,s,objective=preferences(lambda n, i: int(i is s1 and n < 2)))
+    return result.objective == 0 and staff[:2] == [s2, s2]
+    
+def case12():
+    # --- solution; a busy day, found well within the time limit ----
+    #appointments
+    a = [Appointment(i % 21, i % 21 + 1, ['needle'], ['nurse']) for i in range(150)]
+    
+    #resources
+    r1 = Resource('needle', 150, False)
+    r = [r1]
+    
+    #staff
+    s = [Staff('Nurse' + str(i), 'nurse', 1, 8) for i in range(30)]
+    
+    return solve_schedule(a,r,s,time_limit=30) is True
+    
+def case13():
+    # --- counting schedules; any nurse can take any of three back-to-back appointments ----
+    #appointments
+    a = [Appointment(i, i + 1, ['needle'], ['nurse']) for i in range(3)]
+    
+    #resources
+    r1 = Resource('needle', 3, False)
+    r = [r1]
+    
+    #staff
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 3) for i in range(2)]
+    
+    schedules = list(find_schedules(a,r,s))
+    if len(schedules) != 8 or len(set(tuple(l) for l in schedules)) != 8:
+        return False
+    result = count_schedules(a,r,s)
+    if result.status != SAT or result.nSolutions != 8:
+        return False
+    if len(list(find_schedules(a,r,s,limit=3))) != 3 or list(find_schedules(a,r,s,limit=0)):
+        return False
+    result = count_schedules(a,r,s,limit=3)
+    if result.status != UNKNOWN or result.reason != 'limit' or result.nSolutions != 3:
+        return False
+    result = count_schedules(a,r,s,limit=8)
+    return result.status == SAT and result.nSolutions == 8 and count_schedules(a,r,s,limit=0).nSolutions == 0
+    
+def pigeonhole(n):
+    # n pigeons, n - 1 holes, no two pigeons in the same hole: no solution, and forward
+    # checking takes a very long time to show it
+    pigeons = [Variable('Pigeon' + str(i), list(range(n - 1))) for i in range(n)]
+    csp = CSP('pigeonhole', pigeons)
+    for i in range(n):
+        for j in range(i + 1, n):
+            c = Constraint('ne', [pigeons[i], pigeons[j]])
+            c.add_satisfying_tuples((x, y) for x in range(n - 1) for y in range(n - 1) if x != y)
+            csp.add_constraint(c)
+    return csp
+    
+def case14():
+    # --- search limits; each one stops a hard search with its reason ----
+    csp = pigeonhole(12)
+    result = BT(csp).solve(prop_FC, node_limit=100)
+    if result.status != UNKNOWN or result.reason != 'nodes' or result.nDecisions != 100:
+        return False
+    result = BT(csp).solve(prop_FC, fail_limit=50)
+    if result.status != UNKNOWN or result.reason != 'fails' or result.nFails != 50:
+        return False
+    result = BT(csp).solve(prop_FC, time_limit=0.5)
+    if result.status != UNKNOWN or result.reason != 'time' or result.assignment is not None:
+        return False
+    # a small one is still proved to have no solution
+    return BT(pigeonhole(5)).solve(prop_FC).status == UNSAT
+    
+def case15():
+    # --- cancelling a hard search from another thread; a schedule search out of time ----
+    token = CancelToken()
+    timer = threading.Timer(0.5, token.cancel)
+    timer.start()
+    result = BT(pigeonhole(12)).solve(prop_FC, cancel=token)
+    timer.join()
+    if result.status != UNKNOWN or result.reason != 'cancelled':
+        return False
+    
+    a = [Appointment(i, i + 1, ['needle'], ['nurse']) for i in range(3)]
+    r = [Resource('needle', 3, False)]
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 3) for i in range(2)]
+    return solve_schedule(a,r,s,time_limit=0) is None and solve_schedule(a,r,s) is True
+    
+def random_tables(table_class, seed):
+    # the same random CSP (binary and ternary tables) each time for a seed, with the tables
+    # stored by table_class
+    rnd = random.Random(seed)
+    variables = [Variable('V' + str(i), list(range(4))) for i in range(7)]
+    csp = CSP('tables', variables)
+    for k in range(8):
+        scope = rnd.sample(variables, rnd.choice([2, 3]))
+        tuples = [t for t in itertools.product(range(4), repeat=len(scope)) if rnd.random() < 0.6]
+        c = table_class('table' + str(k), scope)
+        c.add_satisfying_tuples(tuples)
+        csp.add_constraint(c)
+    return csp
+    
+def case16():
+    # --- compact tables give the same solutions as plain tables under GAC, and GAC-2001 (with
+    # its residues) the same as GAC ----
+    for seed in range(10):
+        plain = BT(random_tables(Constraint, seed)).count_solutions(prop_GAC)
+        compact = BT(random_tables(CompactTableConstraint, seed)).count_solutions(prop_GAC)
+        if plain.status != compact.status or plain.nSolutions != compact.nSolutions:
+            return False
+        for table_class in (Constraint, CompactTableConstraint):
+            gac2001 = BT(random_tables(table_class, seed)).count_solutions(prop_GAC2001)
+            if gac2001.status != plain.status or gac2001.nSolutions != plain.nSolutions:
+                return False
+        if compact.nDecisions == 0 or compact.nPrunings == 0:
+            return False
+    
+    # a table with no tuples stays violated once its only variable is presolved away
+    a = Variable('A', [0])
+    csp = CSP('empty table', [a])
+    csp.add_constraint(CompactTableConstraint('none', [a]))
+    if BT(csp).solve(prop_GAC).status != UNSAT:
+        return False
+    csp.eliminate_fixed_vars()
+    return csp.infeasible and BT(csp).solve(prop_GAC).status == UNSAT
+    
+def resource_csp(cumulative, capacity):
+    # two uses fixed to the needle at 0-2, and one that can take the needle or the syringe
+    a = Variable('A', ['needle'])
+    b = Variable('B', ['needle'])
+    c = Variable('C', ['needle', 'syringe'])
+    csp = CSP('resources', [a, b, c])
+    if cumulative:
+        csp.add_constraint(CumulativeConstraint('reusable', [a, b, c], [(0, 2), (0, 2), (5, 6)],
+                                                {'needle': capacity}))
+    else:
+        csp.add_constraint(CapacityConstraint('nonreusable', [a, b, c], {'needle': capacity}))
+    return csp
+    
+def case17():
+    # --- resource constraints give the same answer with and without presolving ----
+    for cumulative in (False, True):
+        for capacity, status in ((1, UNSAT), (2, SAT)):
+            for propagator in (prop_FC, prop_GAC):
+                csp = resource_csp(cumulative, capacity)
+                if BT(csp).solve(propagator).status != status:
+                    return False
+                csp.eliminate_fixed_vars()
+                if BT(csp).solve(propagator).status != status:
+                    return False
+    
+    # a use over an empty interval needs no capacity
+    a = Variable('A', ['needle'])
+    csp = CSP('empty interval', [a])
+    csp.add_constraint(CumulativeConstraint('reusable', [a], [(3, 3)], {'needle': 0}))
+    return BT(csp).solve(prop_FC).status == SAT and BT(csp).solve(prop_GAC).status == SAT
+    
+def case18():
+    # --- splitting a search between processes; small budgets so subproblems are handed back ----
+    sequential = BT(pigeonhole(7)).solve(prop_FC)
+    parallel = BT(pigeonhole(7)).solve_parallel(prop_FC, pigeonhole, (7,), processes=2, split_nodes=50)
+    # no subtree is skipped, and none is searched twice (only the decisions fixing each
+    # subproblem's variables are repeated)
+    if parallel.status != UNSAT or parallel.nDecisions > 1.15 * sequential.nDecisions:
+        return False
+    for seed in range(3):
+        csp = random_tables(Constraint, seed)
+        result = BT(csp).solve_parallel(prop_GAC, random_tables, (Constraint, seed), processes=2, 
+                                        split_nodes=2)
+        if result.status != SAT:
+            return False
+        for c in csp.get_all_cons():
+            if not c.check([result.assignment[v] for v in c.get_scope()]):
+                return False
+    return True
+    
+class CrashingAppointment(Appointment):
+    # kills the worker process that receives it
+    def __setstate__(self, state):
+        os._exit(1)
+        
+class StuckAppointment(Appointment):
+    # keeps the worker process that receives it busy for much longer than any time limit
+    def __setstate__(self, state):
+        time.sleep(60)
+    
+def case19():
+    # --- solving many problems; bad ones do not stop the others ----
+    r = [Resource('needle', 3, False)]
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 3) for i in range(2)]
+    good = ([Appointment(i, i + 1, ['needle'], ['nurse']) for i in range(3)], r, s)
+    error = ([Appointment(1, 2, ['needle'], ['nurse'])], r, [Staff('Nurse', 'nurse', 0, None)])
+    crash = ([CrashingAppointment(1, 2, ['needle'], ['nurse'])], r, s)
+    stuck = ([StuckAppointment(1, 2, ['needle'], ['nurse'])], r, s)
+    problems = [good, error, good, stuck, crash, good, good]
+    
+    results = list(solve_many(problems, processes=2, time_limit=1))
+    if sorted(k for k, result, staff in results) != list(range(len(problems))):
+        return False
+    # in completion order: the stuck problem is the last one to give up
+    if results[-1][0] != 3 or results[-1][1].status != UNKNOWN or results[-1][1].reason != 'time':
+        return False
+    for k, result, staff in results:
+        if problems[k] is good and (result.status != SAT or len(staff) != 3):
+            return False
+        if problems[k] in (error, crash) and not (result.status == UNKNOWN and 
+                                                  result.reason.startswith('error')):
+            return False
+    return True
+    
+def case20():
+    # --- racing configurations; the first answer is kept, and the time limit is for the race ----
+    configs = [(prop_FC, 'domain', None), (prop_GAC, 'domain', None)]
+    result = portfolio_solve(pigeonhole(6), pigeonhole, (6,), configs, processes=2)
+    if result.status != UNSAT or not result.config in configs:
+        return False
+    a = [Appointment(i, i + 1, ['needle'], ['nurse']) for i in range(3)]
+    r = [Resource('needle', 3, False)]
+    s = [Staff('Nurse' + str(i), 'nurse', 0, 3) for i in range(2)]
+    result, staff = find_schedule_portfolio(a,r,s,processes=2)
+    if result.status != SAT or not result.config in PORTFOLIO or len(staff) != 3:
+        return False
+    
+    # three searches that cannot finish share one process, but not three time limits
+    start = time.monotonic()
+    result = portfolio_solve(pigeonhole(12), pigeonhole, (12,), [(prop_FC, 'domain', None)] * 3,
+                             processes=1, time_limit=1)
+    elapsed = time.monotonic() - start
+    return (result.status == UNKNOWN and result.reason == 'time' and result.config is None
+            and elapsed < 2)
 
 if __name__ == "__main__":
     
@@ -341,7 +645,7 @@ if __name__ == "__main__":
     tests_long = [case1(), not case2()]     # *** comment out this line to skip the long tests
     
     # shorter test cases for each set of constraints
-    tests_short = [not case3a(), case3b(), not case4a(), case4b(), not case5a(), case5b(), not case6a(), case6b(), not case7a(), case7b(), not case8a(), case8b()] + tests_long
+    tests_short = [not case3a(), case3b(), not case4a(), case4b(), not case5a(), case5b(), not case6a(), case6b(), not case7a(), case7b(), not case8a(), case8b(), not case9a(), case9b(), case10(), case11(), case12(), case13(), case14(), case15(), case16(), case17(), case18(), case19(), case20()] + tests_long
     
     passall = 0
     for i in tests_short: